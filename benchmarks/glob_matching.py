@@ -0,0 +1,111 @@
+"""Checks the worker's glob matching against a corpus of globs and paths with known results, then compares
+the speed of matching paths against VS Code's default excludes one regex at a time, and with a GlobSet.
+
+Usage: python benchmarks/glob_matching.py [number of paths, default 200000]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'worker'))
+
+import tools
+
+# (glob, path, expected)
+CORPUS = [
+    ('**/node_modules', 'node_modules', True),
+    ('**/node_modules', 'web/node_modules', True),
+    ('**/node_modules', '/home/user/web/node_modules', True),
+    ('**/node_modules', 'web/my_node_modules', False),
+    ('**/node_modules', 'web/node_modules/left-pad', False),
+    ('**/node_modules/**', 'web/node_modules/left-pad/index.js', True),
+    ('**/node_modules/**', 'node_modules', True),
+    ('**/node_modules/**', 'web/node_modules_old/index.js', False),
+    ('**/.git/objects/**', '/repo/.git/objects/ab/cdef', True),
+    ('**/.git/objects/**', '/repo/.git/refs/heads', False),
+    ('**/.git/objects/**', '/repo/git/objects/ab', False),
+    ('**/*.pyc', 'src/module.pyc', True),
+    ('**/*.pyc', 'module.pyc', True),
+    ('**/*.pyc', 'src/module.py', False),
+    ('**/*.pyc', 'src/module.pyc/data', False),
+    ('*.py', 'setup.py', True),
+    ('*.py', 'src/setup.py', False),
+    ('src/**', 'src', True),
+    ('src/**', 'src/a/b.c', True),
+    ('src/**', 'srcs/a', False),
+    ('a/**/b', 'a/b', True),
+    ('a/**/b', 'a/x/y/b', True),
+    ('a/**/b', 'a/xb', False),
+    ('**', 'any/path/at/all', True),
+    ('fo?', 'foo', True),
+    ('fo?', 'fo/', False),
+    ('fo?', 'fooo', False),
+    ('**/*.{js,ts}', 'lib/index.ts', True),
+    ('**/*.{js,ts}', 'lib/index.json', False),
+    ('{build,dist}/**', 'dist/bundle.js', True),
+    ('{build,dist}/**', 'src/dist/bundle.js', False),
+    ('**/[Tt]humbs.db', 'pics/thumbs.db', True),
+    ('**/[Tt]humbs.db', 'pics/humbs.db', False),
+    ('**/*.code-search', 'saved.code-search', True),
+]
+
+# Match none of the corpus' paths; combined with each of its globs, to check they don't interfere.
+DECOY_GLOBS = ['**/decoy', '**/*.decoy', '**/decoy/**', 'decoy/**/*.c', '{x,y}/decoy']
+
+# VS Code's default files.exclude, search.exclude and files.watcherExclude.
+DEFAULT_EXCLUDES = [
+    '**/.git', '**/.svn', '**/.hg', '**/CVS', '**/.DS_Store', '**/Thumbs.db',
+    '**/node_modules', '**/bower_components', '**/*.code-search',
+    '**/.git/objects/**', '**/.git/subtree-cache/**', '**/node_modules/*/**', '**/.hg/store/**',
+]
+
+def check_corpus():
+    failures = 0
+    for glob, path, expected in CORPUS:
+        results = {
+            'regexp': tools.vscode_glob_to_regexp(glob).match(path) is not None,
+            'GlobSet': tools.GlobSet([glob]).match(path),
+            'GlobSet (combined)': tools.GlobSet([glob] + DECOY_GLOBS).match(path),
+        }
+        for matcher, result in results.items():
+            if result != expected:
+                failures += 1
+                print('FAIL %-18s %-24s %-40s expected %s' % (matcher, glob, path, expected))
+    print('%d / %d corpus checks passed' % (len(CORPUS) * 3 - failures, len(CORPUS) * 3))
+    return failures == 0
+
+def generate_paths(count):
+    rng = random.Random(0)
+    segments = ['src', 'lib', 'test', 'node_modules', 'build', 'components', 'utils', '.git', 'objects', 'docs', 'vendor']
+    names = ['index.js', 'main.py', 'README.md', 'Thumbs.db', 'app.ts', 'style.css', 'data.json', 'search.code-search']
+    paths = []
+    for i in range(count):
+        depth = rng.randint(1, 7)
+        paths.append('/home/user/project/' + '/'.join(rng.choice(segments) for j in range(depth)) + '/' + rng.choice(names))
+    return paths
+
+def main():
+    count = int(sys.argv[1] if len(sys.argv) > 1 else 200000)
+    if not check_corpus():
+        sys.exit(1)
+
+    paths = generate_paths(count)
+    regexes = [tools.vscode_glob_to_regexp(glob) for glob in DEFAULT_EXCLUDES]
+
+    start = time.time()
+    expected = [any(regex.match(path) for regex in regexes) for path in paths]
+    separate = time.time() - start
+
+    start = time.time()
+    glob_set = tools.get_glob_set(DEFAULT_EXCLUDES)
+    actual = [glob_set.match(path) for path in paths]
+    combined = time.time() - start
+
+    assert actual == expected, 'GlobSet disagrees with separate regexes'
+    print('%d paths, %d globs, %d excluded' % (count, len(DEFAULT_EXCLUDES), sum(expected)))
+    print('separate regexes: %7.0f paths/ms' % (count / separate / 1000))
+    print('GlobSet:          %7.0f paths/ms  (%.1fx)' % (count / combined / 1000, separate / combined))
+
+if __name__ == '__main__':
+    main()
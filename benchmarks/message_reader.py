@@ -0,0 +1,90 @@
+"""Compares the worker's MessageReader with the original reader (a msgpack Unpacker pulling from a file-like object
+which read each message 16 KB at a time; here with the same msgpack) on a stream of size-prefixed messages read from a file: messages/sec
+for small requests, and MB/s for large binary messages such as upload chunks.
+
+Usage: python benchmarks/message_reader.py [number of small messages, default 200000] [MB of large messages, default 256]
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'worker'))
+
+import msgpack
+import protocol
+from codec import get_codec
+
+LARGE_MESSAGE_SIZE = 1024 * 1024
+
+class OldMessageReader:
+    # As requests were originally read from stdin.
+    def __init__(self, stream):
+        self.stream = stream
+        self.message_size = 0
+
+    def read_message_size(self):
+        pack_header = self.stream.read(1)
+        if len(pack_header) == 0:
+            return 0
+
+        read_size = { 0xcc: 1, 0xcd: 2, 0xce: 4, 0xcf: 8 }.get(ord(pack_header), 0)
+        if read_size > 0:
+            pack_header += self.stream.read(read_size)
+        self.message_size = msgpack.unpackb(pack_header, raw=True)
+
+    def read(self, bytes):
+        if self.message_size <= 0:
+            self.read_message_size()
+
+        read_bytes = self.stream.read(min(16384, self.message_size))
+        self.message_size -= len(read_bytes)
+        return read_bytes
+
+def old_reader(stream):
+    # With the same msgpack as MessageReader, so only the way input is read differs.
+    codec = get_codec()
+    return codec.module.Unpacker(OldMessageReader(stream), **codec.unpacker_options)
+
+def new_reader(stream):
+    return protocol.MessageReader(stream)
+
+def write_messages(path, messages):
+    with open(path, 'wb') as fh:
+        for message in messages:
+            packed = msgpack.packb(message, use_bin_type=True)
+            fh.write(msgpack.packb(len(packed)) + packed)
+
+def read_all(make_reader, path):
+    with io.open(path, 'rb') as stream:
+        start = time.time()
+        count = sum(1 for message in make_reader(stream))
+        return count, time.time() - start
+
+def main():
+    small_count = int(sys.argv[1] if len(sys.argv) > 1 else 200000)
+    large_count = int(sys.argv[2] if len(sys.argv) > 2 else 256)
+    root = tempfile.mkdtemp()
+    try:
+        small_path = os.path.join(root, 'small')
+        write_messages(small_path, ([3, {'path': '~/project/src/module-%d.py' % i, 'cachedHash': '%032x' % i}] for i in range(small_count)))
+        large_path = os.path.join(root, 'large')
+        chunk = os.urandom(LARGE_MESSAGE_SIZE)
+        write_messages(large_path, (chunk for i in range(large_count)))
+
+        # A system-installed msgpack with its C extension is much faster than the bundled one; say which is in use.
+        print('codec: ' + get_codec().name)
+        for label, make_reader in [('original reader', old_reader), ('MessageReader', new_reader)]:
+            count, small_time = read_all(make_reader, small_path)
+            assert count == small_count, 'read %d small messages, expected %d' % (count, small_count)
+            count, large_time = read_all(make_reader, large_path)
+            assert count == large_count, 'read %d large messages, expected %d' % (count, large_count)
+            print('%-16s small: %9.0f messages/s   large (1 MB): %7.0f MB/s' % (
+                label, small_count / small_time, large_count * LARGE_MESSAGE_SIZE / large_time / (1024 * 1024)))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Compares listing directories with os.listdir + os.stat per child, as LS originally did, against the worker's
+scandir based stat_children, on wide, deep and symlink-heavy temporary trees. Checks both give the same results.
+
+Usage: python benchmarks/scandir_listing.py [files per tree, default 20000]
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'worker'))
+
+import tools
+
+# Times each tree is listed in full; the best run is reported.
+REPEATS = 5
+
+def build_wide(root, files):
+    # One directory holding every file.
+    for i in range(files):
+        open(os.path.join(root, 'file-%d' % i), 'w').close()
+
+def build_deep(root, files):
+    # Directories nested eight deep, four to a parent, with a few files in each.
+    for i in range(files // 8):
+        directory = os.path.join(root, *('d%d' % ((i >> shift) & 3) for shift in range(0, 16, 2)))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for j in range(8):
+            open(os.path.join(directory, 'file-%d-%d' % (i, j)), 'w').close()
+
+def build_symlinks(root, files):
+    # Mostly links: to files, to directories, and broken.
+    targets = os.path.join(root, 'targets')
+    os.mkdir(targets)
+    for i in range(files // 4):
+        open(os.path.join(targets, 'file-%d' % i), 'w').close()
+    links = os.path.join(root, 'links')
+    os.mkdir(links)
+    for i in range(files):
+        target = ['../targets/file-%d' % (i // 4), '../targets', 'missing-%d' % i][i % 3]
+        os.symlink(target, os.path.join(links, 'link-%d' % i))
+
+def old_stat_children(path):
+    # As LS did before scandir.
+    children = []
+    for name in os.listdir(path):
+        child_path = os.path.join(path, name)
+        try:
+            children.append((name, child_path, os.stat(child_path)))
+        except OSError as err:
+            logging.warning('Skipping ' + child_path + ': ' + str(err))
+    return children
+
+def directories(root):
+    return [root] + [path for path in tools.walk_directories(root, lambda name, path: False) if path != root]
+
+def list_tree(stat_children, paths):
+    results = {}
+    for path in paths:
+        results[path] = sorted((name, tools.process_stat(child_stat)[0], child_stat.st_size) for name, child_path, child_stat in stat_children(path))
+    return results
+
+def best_time(stat_children, paths):
+    best = None
+    for i in range(REPEATS):
+        start = time.time()
+        for path in paths:
+            stat_children(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    files = int(sys.argv[1] if len(sys.argv) > 1 else 20000)
+    print('scandir %s; %d files per tree' % ('available' if tools.scandir else 'unavailable', files))
+
+    # Broken links are logged as they're skipped; don't flood the output.
+    logging.disable(logging.WARNING)
+
+    for name, build in [('wide', build_wide), ('deep', build_deep), ('symlinks', build_symlinks)]:
+        root = tempfile.mkdtemp()
+        try:
+            build(root, files)
+            paths = directories(root)
+            if list_tree(old_stat_children, paths) != list_tree(tools.stat_children, paths):
+                print('FAIL %s: listings differ' % name)
+                sys.exit(1)
+
+            old = best_time(old_stat_children, paths)
+            new = best_time(tools.stat_children, paths)
+            print('%-9s listdir + stat: %7.1f ms   stat_children: %7.1f ms  (%.2fx)' % (name, old * 1000, new * 1000, old / new))
+        finally:
+            shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
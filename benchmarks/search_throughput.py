@@ -0,0 +1,68 @@
+"""Measures how fast the worker's SEARCH handler scans a synthetic corpus of source-like text files,
+in-process and across its pool of search processes.
+
+Usage: python benchmarks/search_throughput.py [corpus size in MB, default 256]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'worker'))
+
+import search
+
+WORDS = ['return', 'self', 'value', 'index', 'buffer', 'import', 'def', 'class', 'if', 'else', 'for', 'while',
+         'None', 'True', 'path', 'result', 'error', 'data', 'length', 'offset', '=', '(', ')', ':', '+', '0', '1']
+
+FILE_SIZE = 1024 * 1024
+
+def build_corpus(root, size):
+    # Much the same text in every file; searches scan it in full, as they would a real tree.
+    rng = random.Random(0)
+    lines = []
+    while sum(len(line) for line in lines) < FILE_SIZE:
+        lines.append(' ' * rng.randint(0, 12) + ' '.join(rng.choice(WORDS) for i in range(rng.randint(2, 14))) + '\n')
+    text = ''.join(lines).encode('utf-8')
+
+    for i in range(max(1, size // FILE_SIZE)):
+        directory = os.path.join(root, 'dir-%d' % (i // 32))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'file-%d.py' % i), 'wb') as fh:
+            fh.write(text)
+            if i % 16 == 0:
+                fh.write(b'needle_in_a_haystack = 1\n')
+
+def run(label, pool, root, args):
+    search.loaded_search_pool = pool
+    start = time.time()
+    text_search = search.TextSearch(root, args)
+    matches = sum(len(matches) for results in text_search.run() for path, matches in results)
+    elapsed = time.time() - start
+
+    print('%-24s %6.2f GB/s  (%d MB in %.2f s, %d files, %d matches)' % (
+        label, text_search.bytes / elapsed / 1e9, text_search.bytes // (1024 * 1024), elapsed, text_search.files, matches))
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 256) * 1024 * 1024
+    root = tempfile.mkdtemp()
+    try:
+        build_corpus(root, size)
+        pool = search.create_search_pool()
+        queries = [
+            ('literal', {'pattern': 'needle_in_a_haystack', 'isCaseSensitive': True}),
+            ('literal, ignoring case', {'pattern': 'Needle_In_A_Haystack'}),
+            ('regex', {'pattern': r'needle_\w+\s*=', 'isRegExp': True, 'isCaseSensitive': True}),
+        ]
+        for name, args in queries:
+            run(name + ' (in-process)', False, root, args)
+            if pool:
+                run(name + ' (processes)', pool, root, args)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Compares listing and watch-tree walking with and without the worker's parallel stat engine, on a
+temporary tree where every stat / listdir is artificially delayed to mimic a network filesystem.
+
+Usage: python benchmarks/stat_fanout.py [delay in ms, default 2]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'worker'))
+
+import statengine
+import tools
+
+def delayed(function, delay):
+    # time.sleep releases the GIL, as a real filesystem call waiting on the network would.
+    def wrapper(*args, **kwargs):
+        time.sleep(delay)
+        return function(*args, **kwargs)
+    return wrapper
+
+def build_tree(root, directories, files):
+    for i in range(directories):
+        directory = os.path.join(root, 'dir-%d' % i)
+        os.makedirs(os.path.join(directory, 'sub'))
+        for j in range(files):
+            open(os.path.join(directory, 'file-%d' % j), 'w').close()
+
+def run(label, max_threads, root):
+    statengine.loaded_stat_engine = statengine.StatEngine(max_threads)
+
+    start = time.time()
+    for name in os.listdir(root):
+        tools.stat_children(os.path.join(root, name))
+    listed = time.time() - start
+
+    start = time.time()
+    walked = len(list(tools.walk_directories(root, lambda name, path: False)))
+    walk_time = time.time() - start
+
+    print('%-10s list: %7.1f ms   walk (%d dirs): %7.1f ms' % (label, listed * 1000, walked, walk_time * 1000))
+    return listed + walk_time
+
+def main():
+    delay = float(sys.argv[1] if len(sys.argv) > 1 else 2) / 1000
+    root = tempfile.mkdtemp()
+    originals = (os.stat, os.listdir, tools.scandir, tools.stat_entry)
+    try:
+        build_tree(root, 20, 50)
+
+        os.stat = delayed(os.stat, delay)
+        os.listdir = delayed(os.listdir, delay)
+        tools.stat_entry = delayed(tools.stat_entry, delay)
+        if tools.scandir is not None:
+            tools.scandir = delayed(tools.scandir, delay)
+
+        print('Each stat / listdir delayed by %.1f ms' % (delay * 1000))
+        serial = run('serial', 1, root)
+        parallel = run('parallel', statengine.MAX_THREADS, root)
+        print('speedup: %.1fx' % (serial / parallel))
+    finally:
+        os.stat, os.listdir, tools.scandir, tools.stat_entry = originals
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Measures how long a recursive ADD_WATCH takes until every directory of a synthetic tree is watched, comparing the
+original recursive listdir / islink / isdir / access walk with the iterative scandir walk the watcher now uses.
+Wide (many directories under one parent) and deep (a tree of nested directories) trees are tried, each
+directory holding some files the walk has to skip past.
+
+Usage: python benchmarks/watch_tree.py [directories per tree, default 5000]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'worker'))
+
+import watcher
+
+FILES_PER_DIRECTORY = 8
+
+def build_wide(root, directories):
+    for i in range(directories - 1):
+        os.mkdir(os.path.join(root, 'dir-%d' % i))
+
+def build_deep(root, directories):
+    # Breadth first, four children to a parent.
+    pending = [root]
+    created = 1
+    while created < directories:
+        parent = pending.pop(0)
+        for i in range(min(4, directories - created)):
+            child = os.path.join(parent, 'dir-%d' % i)
+            os.mkdir(child)
+            pending.append(child)
+            created += 1
+
+def add_files(root):
+    for directory, subdirectories, files in os.walk(root):
+        for i in range(FILES_PER_DIRECTORY):
+            open(os.path.join(directory, 'file-%d' % i), 'w').close()
+
+def old_find_paths(self, path, recursive, excludes):
+    # As the watcher walked trees before walk_directories.
+    yield path
+    if recursive and os.path.isdir(path):
+        for name in os.listdir(path):
+            child = os.path.join(path, name)
+            is_dir = not os.path.islink(child) and os.path.isdir(child)
+            if is_dir and name != '.pony-ssh' and not excludes.match(child):
+                if os.access(child, os.R_OK):
+                    for child_path in old_find_paths(self, child, True, excludes):
+                        yield child_path
+
+def time_watch(root):
+    # Best of a few runs; each watches the whole tree from scratch on a fresh inotify descriptor.
+    best = None
+    for i in range(3):
+        tree_watcher = watcher.Watcher()
+        try:
+            start = time.time()
+            tree_watcher.add_watch(1, root, True, [])
+            elapsed = time.time() - start
+            watched = len(tree_watcher.watch_descriptors)
+        finally:
+            tree_watcher.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, watched
+
+def main():
+    directories = int(sys.argv[1] if len(sys.argv) > 1 else 5000)
+    new_find_paths = watcher.Watcher.find_paths
+    for name, build in [('wide', build_wide), ('deep', build_deep)]:
+        root = tempfile.mkdtemp()
+        try:
+            build(root, directories)
+            add_files(root)
+
+            watcher.Watcher.find_paths = old_find_paths
+            old, old_watched = time_watch(root)
+            watcher.Watcher.find_paths = new_find_paths
+            new, new_watched = time_watch(root)
+
+            if old_watched != new_watched:
+                print('FAIL %s: watched %d directories, originally %d' % (name, new_watched, old_watched))
+                sys.exit(1)
+            print('%-5s %d directories watched  recursive walk: %7.1f ms   scandir walk: %7.1f ms  (%.2fx)' % (
+                name, new_watched, old * 1000, new * 1000, old / new))
+        finally:
+            watcher.Watcher.find_paths = new_find_paths
+            shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,11 @@ export enum Opcode {
     RENAME          = 0x07,
     EXPAND_PATH     = 0x08,
     FILE_WRITE_DIFF = 0x09,
+    FILE_UPLOAD     = 0x0A,
+    BULK_READ       = 0x0B,
+    VALIDATE        = 0x0C,
+    SEARCH          = 0x0D,
+    FIND            = 0x0E,
     ADD_WATCH       = 0x10,
     REMOVE_WATCH    = 0x11,
 }
@@ -287,7 +292,7 @@ export class PonyWorker extends EventEmitter {
 
                     case ParcelType.HEADER:
                         header = msgpackDecode( data );
-                        if ( header && ! header.length ) {
+                        if ( header && ! header.length && ! header.streaming ) {
                             // Header with no body. We're done here.
                             resolve( header! );
                             return false;
@@ -304,7 +309,8 @@ export class PonyWorker extends EventEmitter {
 
                     case ParcelType.ENDOFBODY:
                         if ( header !== undefined ) {
-                            if ( bodyLength !== header.length ) {
+                            // Streaming bodies (eg; LS with stream set) run until ENDOFBODY, with no length given.
+                            if ( ! header.streaming && bodyLength !== header.length ) {
                                 log.warn( 'Warning: Header said ' + header.length + ' bytes, body was ' + bodyLength + 'bytes' );
                             }
                             resolve( header! );
@@ -1,21 +1,146 @@
+import time
+start_time = time.time()
+
+import hashlib
 import logging
 import os
 import sys
+import threading
 import traceback
 
+logging.basicConfig(filename=os.path.expanduser('~/.pony-ssh/debug.log'), level=logging.DEBUG)
+
+BYTECODE_CACHE_PATH = '~/.pony-ssh/cache'
+
+# Cached copies of other worker versions are removed once unused for this long (seconds).
+STALE_CACHE_AGE = 24 * 60 * 60
+
+# A cache's mtime records when it was last used, updated at most this often (seconds); see touch_bytecode_cache.
+CACHE_TOUCH_INTERVAL = 60 * 60
+
+def file_hash(path):
+    # Matches the hash the client computes when deciding whether to upload a new worker.
+    hasher = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def read_cache_marker(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, '.complete'), 'r') as fh:
+            return fh.read().strip()
+    except (IOError, OSError):
+        return None
+
+def build_bytecode_cache(zip_path, cache_root, cache_dir, worker_hash):
+    import compileall
+    import shutil
+    import tempfile
+    import zipfile
+
+    # Extract and compile somewhere private, then move into place in one step; concurrent
+    # workers never see a partial cache.
+    temp_dir = tempfile.mkdtemp(prefix='.building-', dir=cache_root)
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            archive.extractall(temp_dir)
+        compileall.compile_dir(temp_dir, quiet=1)
+        with open(os.path.join(temp_dir, '.complete'), 'w') as fh:
+            fh.write(worker_hash)
+
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        try:
+            os.rename(temp_dir, cache_dir)
+        except OSError:
+            # Another worker got there first.
+            if read_cache_marker(cache_dir) != worker_hash:
+                raise
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    # Tidy up after previous versions of the worker.
+    now = time.time()
+    for name in os.listdir(cache_root):
+        path = os.path.join(cache_root, name)
+        if path != cache_dir and (name.startswith('worker-') or name.startswith('.building-')):
+            if now - os.path.getmtime(path) > STALE_CACHE_AGE:
+                shutil.rmtree(path, ignore_errors=True)
+
+def touch_bytecode_cache(cache_dir):
+    # Cache hits don't otherwise modify the cache, and caches are judged stale by their mtime.
+    try:
+        if time.time() - os.path.getmtime(cache_dir) > CACHE_TOUCH_INTERVAL:
+            os.utime(cache_dir, None)
+    except OSError as err:
+        logging.warning('Failed to touch bytecode cache: ' + str(err))
+
+def get_worker_hash(worker_path):
+    if os.path.isfile(worker_path):
+        return file_hash(worker_path)
+    # Running from a source directory; identify it by location instead.
+    return hashlib.md5(os.path.abspath(worker_path).encode('utf-8')).hexdigest()
+
+def use_bytecode_cache(zip_path, worker_hash):
+    """When running from worker.zip, imports from an extracted and compiled copy of it instead;
+    Python never caches bytecode for modules imported from a zip. Returns a description of the cache used."""
+    if not os.path.isfile(zip_path):
+        return 'none'
+
+    try:
+        cache_root = os.path.expanduser(BYTECODE_CACHE_PATH)
+        cache_dir = os.path.join(cache_root, 'worker-' + worker_hash)
+
+        status = 'hit'
+        if read_cache_marker(cache_dir) != worker_hash:
+            status = 'miss'
+            if not os.path.exists(cache_root):
+                os.makedirs(cache_root)
+            build_bytecode_cache(zip_path, cache_root, cache_dir, worker_hash)
+        else:
+            touch_bytecode_cache(cache_dir)
+
+        sys.path[0] = cache_dir
+        return status
+    except Exception as err:
+        logging.warning('Failed to use bytecode cache: ' + str(err))
+        return 'failed'
+
+worker_hash = get_worker_hash(sys.path[0])
+bytecode_cache = use_bytecode_cache(sys.path[0], worker_hash)
+
 from errors import Error, CodedError, process_error
-from protocol import prepare_message_reader, send_error
-from handlers import message_handlers
-from libc import get_libc
-from watcher import Watcher
+from protocol import get_channel, prepare_message_reader, send_error, set_channel, set_request_id, MAX_CONCURRENT_REQUESTS
 
-import traceback
-logging.basicConfig(filename=os.path.expanduser('~/.pony-ssh/debug.log'), level=logging.DEBUG)
+def log_startup(mode, started):
+    # started is when this process started, or (in a daemon) the process relaying to it.
+    elapsed = time.time() - started
+    logging.info('%s ready in %d ms (bytecode cache: %s)' % (mode, elapsed * 1000, bytecode_cache))
+    return elapsed
+
+def parse_options(args):
+    # Options are passed as --name=value after the mode (if any)
+    options = {}
+    for arg in args:
+        if arg.startswith('--') and '=' in arg:
+            name, value = arg[2:].split('=', 1)
+            options[name] = value
+    return options
 
-def run_watcher():
+def run_watcher(options, started):
+    watcher = None
     try:
+        from libc import get_libc
+        from watcher import Watcher, COALESCE_WINDOW, MAX_LATENCY
+
         get_libc()
-        watcher = Watcher()
+        watcher = Watcher(
+            coalesce_window=float(options.get('coalesce-ms', COALESCE_WINDOW * 1000)) / 1000,
+            max_latency=float(options.get('max-latency-ms', MAX_LATENCY * 1000)) / 1000,
+        )
+        log_startup('Watcher', started)
         watcher.run()
     except CodedError as err:
         send_error(err.code, err.message)
@@ -27,29 +152,96 @@ def run_watcher():
         if hasattr(err, '__traceback__'):
             logging.warning(''.join(traceback.format_tb(err.__traceback__)))
         send_error(Error.EINVAL, str(err) + '\n' + traceback.format_exc())
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+def handle_message(message, message_reader):
+    from handlers import message_handlers, stream_handlers
+    try:
+        [opcode, args] = message[:2]
+        handler = message_handlers.get(opcode, None)
+        stream_handler = stream_handlers.get(opcode, None)
+        if handler != None:
+            handler(args)
+        elif stream_handler != None:
+            stream_handler(args, message_reader)
+        else:
+            send_error(Error.EINVAL, "Unknown opcode: " + str(opcode))
+    except CodedError as err:
+        send_error(err.code, err.message)
+    except OSError as err:
+        logging.warning(err)
+        send_error(process_error(err.errno), err.strerror)
+    except BaseException as err:
+        logging.warning(err)
+        send_error(Error.EINVAL, str(err) + '\n' + traceback.format_exc())
+    finally:
+        sys.stdout.flush()
 
-def run_worker():
+def handle_tagged_message(message, channel, request_slots):
+    # Runs on a pool thread; parcels sent while handling are tagged with the message's request ID.
+    set_channel(channel)
+    set_request_id(message[2])
+    try:
+        handle_message(message, None)
+    finally:
+        set_request_id(None)
+        request_slots.release()
+
+def run_worker(options, started):
+    from handlers import stream_handlers
+
+    pool = None
+    request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+    channel = get_channel()
     messageUnpacker = prepare_message_reader()
+    channel.startup_time = log_startup('Worker', started)
     for message in messageUnpacker:
-        try:
-            [opcode, args] = message
-            handler = message_handlers.get(opcode, None)
-            if handler != None:
-                handler(args)
-            else:
-                send_error(Error.EINVAL, "Unknown opcode: " + str(opcode))
-        except CodedError as err:
-            send_error(err.code, err.message)
-        except OSError as err:
-            logging.warning(err)
-            send_error(process_error(err.errno), err.strerror)
-        except BaseException as err:
-            logging.warning(err)
-            send_error(Error.EINVAL, str(err) + '\n' + traceback.format_exc())
-        finally:
-            sys.stdout.flush()
-
-if len(sys.argv) > 1 and sys.argv[1] == 'watcher':
-    run_watcher()
+        # Messages with a third element carry a request ID; they may be handled concurrently,
+        # with responses tagged by ID. Untagged messages are handled in order, one at a time.
+        # Requests which read more from the message stream are always handled here, on the reading thread.
+        is_tagged = isinstance(message, list) and len(message) > 2
+        if is_tagged and message[0] in stream_handlers:
+            set_request_id(message[2])
+            try:
+                handle_message(message, messageUnpacker)
+            finally:
+                set_request_id(None)
+        elif is_tagged:
+            if pool is None:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(MAX_CONCURRENT_REQUESTS)
+
+            # Stop reading new requests while every pool thread is busy.
+            request_slots.acquire()
+            pool.apply_async(handle_tagged_message, (message, channel, request_slots))
+        else:
+            handle_message(message, messageUnpacker)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+modes = { 'worker': run_worker, 'watcher': run_watcher }
+
+if len(sys.argv) > 1 and not sys.argv[1].startswith('--'):
+    mode = sys.argv[1]
+    options = parse_options(sys.argv[2:])
 else:
-    run_worker()
+    mode = 'worker'
+    options = parse_options(sys.argv[1:])
+
+if mode == 'daemon':
+    from daemon import run_daemon
+    run_daemon(worker_hash, options, modes)
+else:
+    # With --daemon=on, workers and watchers are hosted by a long-lived daemon, and this process only relays to it.
+    relayed = False
+    if options.get('daemon') == 'on':
+        from daemon import run_relay
+        relayed = run_relay(worker_hash, mode, options, start_time)
+
+    if not relayed:
+        modes.get(mode, run_worker)(options, start_time)
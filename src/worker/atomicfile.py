@@ -0,0 +1,52 @@
+import hashlib
+import io
+import os
+import stat
+
+class AtomicFile:
+    """Collects new content for a file in a temporary file alongside it, hashing as it goes.
+    commit() moves it into place in one step, so readers never see a partially written file."""
+
+    def __init__(self, path):
+        # Replace the target of a symlink, not the link itself.
+        self.path = os.path.realpath(path)
+        directory, name = os.path.split(self.path)
+        import tempfile # Only needed for writes; slow to import.
+        fd, self.temp_path = tempfile.mkstemp(prefix='.' + name + '.', suffix='.pony-tmp', dir=directory)
+        self.fh = io.open(fd, 'wb')
+        self.hasher = hashlib.md5()
+
+    def write(self, data):
+        self.fh.write(data)
+        self.hasher.update(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+    def commit(self):
+        """Moves the new content into place. Returns its stat, taken from the new file itself, not its path."""
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+        # mkstemp creates files private to the user; keep the original file's mode, or use the default for new files.
+        try:
+            mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(self.temp_path, mode)
+
+        os.rename(self.temp_path, self.path)
+
+        # Renaming changes the file's ctime; stat it after.
+        file_stat = os.fstat(self.fh.fileno())
+        self.fh.close()
+        return file_stat
+
+    def discard(self):
+        self.fh.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
@@ -0,0 +1,183 @@
+import logging
+import os
+import struct
+import sys
+import time
+
+import msgpack
+
+# Oldest system-installed msgpack that supports the options used here (raw=False, use_bin_type),
+# and derives its unpacking limits from max_buffer_size.
+MIN_SYSTEM_VERSION = (0, 6, 1)
+
+# Largest message accepted by a system-installed msgpack; newer versions default to far less.
+MAX_MESSAGE_SIZE = 2 ** 31 - 1
+
+# Number of times to pack / unpack a sample response when benchmarking codecs at startup.
+BENCHMARK_ROUNDS = 3
+
+pack_uint8 = struct.Struct('>BB').pack
+pack_uint16 = struct.Struct('>BH').pack
+pack_uint32 = struct.Struct('>BI').pack
+pack_uint64 = struct.Struct('>BQ').pack
+pack_int8 = struct.Struct('>Bb').pack
+pack_int16 = struct.Struct('>Bh').pack
+pack_int32 = struct.Struct('>Bi').pack
+pack_int64 = struct.Struct('>Bq').pack
+pack_byte = struct.Struct('>B').pack
+pack_signed_byte = struct.Struct('>b').pack
+
+def pack_int(value):
+    if 0 <= value < 0x80:
+        return pack_byte(value)
+    elif -0x20 <= value < 0:
+        return pack_signed_byte(value)
+    elif 0 <= value <= 0xff:
+        return pack_uint8(0xcc, value)
+    elif 0 <= value <= 0xffff:
+        return pack_uint16(0xcd, value)
+    elif 0 <= value <= 0xffffffff:
+        return pack_uint32(0xce, value)
+    elif value >= 0:
+        return pack_uint64(0xcf, value)
+    elif value >= -0x80:
+        return pack_int8(0xd0, value)
+    elif value >= -0x8000:
+        return pack_int16(0xd1, value)
+    elif value >= -0x80000000:
+        return pack_int32(0xd2, value)
+    else:
+        return pack_int64(0xd3, value)
+
+def pack_raw(value):
+    # Strings are sent as msgpack raw (str) type, without the str8 header; as the Packer does with use_bin_type=False.
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+
+    size = len(value)
+    if size <= 0x1f:
+        return pack_byte(0xa0 + size) + value
+    elif size <= 0xffff:
+        return pack_uint16(0xda, size) + value
+    else:
+        return pack_uint32(0xdb, size) + value
+
+def pack_map_header(size):
+    if size <= 0x0f:
+        return pack_byte(0x80 + size)
+    elif size <= 0xffff:
+        return pack_uint16(0xde, size)
+    else:
+        return pack_uint32(0xdf, size)
+
+def pack_stat(raw_stat):
+    # Stats are always [ type, mtime, ctime, size ]; see tools.process_stat
+    file_type, mtime, ctime, size = raw_stat
+    return b'\x94' + pack_int(file_type) + pack_int(mtime) + pack_int(ctime) + pack_int(size)
+
+def pack_children(children):
+    parts = [pack_map_header(len(children))]
+    for name, raw_stat in children.items():
+        parts.append(pack_raw(name))
+        parts.append(pack_stat(raw_stat))
+    return b''.join(parts)
+
+def pack_listing(listing):
+    # LS responses look like { 'stat': stat, 'dirs': { relPath: { name: stat } } }; 'dirs' is absent for non-directories.
+    parts = [pack_map_header(len(listing))]
+    for key, value in listing.items():
+        parts.append(pack_raw(key))
+        if key == 'stat':
+            parts.append(pack_stat(value))
+        elif key == 'dirs':
+            parts.append(pack_map_header(len(value)))
+            for rel_path, children in value.items():
+                parts.append(pack_raw(rel_path))
+                parts.append(b'\xc0' if children is None else pack_children(children))
+        else:
+            parts.append(msgpack.packb(value))
+    return b''.join(parts)
+
+class Codec:
+    def __init__(self, name, module, specialised, unpacker_options):
+        self.name = name
+        self.module = module
+        self.specialised = specialised
+        self.unpacker_options = unpacker_options
+
+    def packb(self, value, use_bin_type=False):
+        return self.module.packb(value, use_bin_type=use_bin_type)
+
+    def unpacker(self):
+        return self.module.Unpacker(**self.unpacker_options)
+
+    def pack_listing(self, listing):
+        if self.specialised:
+            return pack_listing(listing)
+        return self.packb(listing)
+
+def is_compiled(module):
+    return not module.Packer.__module__.endswith('fallback')
+
+def load_system_msgpack():
+    """Imports a system-installed msgpack (ie; not the copy bundled with the worker), without disturbing the bundled one."""
+    bundled_root = os.path.abspath(os.path.dirname(os.path.dirname(msgpack.__file__)))
+    bundled_modules = dict((name, module) for (name, module) in sys.modules.items() if name == 'msgpack' or name.startswith('msgpack.'))
+    original_path = sys.path[:]
+
+    try:
+        for name in bundled_modules:
+            del sys.modules[name]
+        sys.path[:] = [entry for entry in sys.path if os.path.abspath(entry or '.') != bundled_root]
+
+        try:
+            return __import__('msgpack')
+        except ImportError:
+            return None
+    finally:
+        sys.path[:] = original_path
+        for name in [name for name in sys.modules if name == 'msgpack' or name.startswith('msgpack.')]:
+            del sys.modules[name]
+        sys.modules.update(bundled_modules)
+
+def benchmark_sample():
+    children = dict(('file-%d.txt' % i, [1, 1580000000 + i, 1580000000 + i, i * 100]) for i in range(100))
+    return { 'stat': [2, 1580000000, 1580000000, 4096], 'dirs': { '.': children, './src': children } }
+
+def benchmark(codec, sample):
+    start = time.time()
+    for _ in range(BENCHMARK_ROUNDS):
+        unpacker = codec.unpacker()
+        unpacker.feed(codec.pack_listing(sample))
+        unpacker.unpack()
+    return time.time() - start
+
+def select_codec():
+    candidates = [Codec('bundled', msgpack, True, { 'raw': False })]
+
+    try:
+        system_msgpack = load_system_msgpack()
+        if system_msgpack is not None:
+            version = getattr(system_msgpack, 'version', (0,))
+            if is_compiled(system_msgpack) and version >= MIN_SYSTEM_VERSION:
+                unpacker_options = { 'raw': False, 'max_buffer_size': MAX_MESSAGE_SIZE }
+                if version >= (1, 0):
+                    unpacker_options['strict_map_key'] = False # msgpack 1.0 refuses non-string map keys by default.
+                name = 'system-' + '.'.join(map(str, version))
+                candidates.append(Codec(name, system_msgpack, False, unpacker_options))
+    except Exception as err:
+        logging.warning('Failed to load system msgpack: ' + str(err))
+
+    if len(candidates) == 1:
+        return candidates[0]
+
+    sample = benchmark_sample()
+    timings = [(benchmark(candidate, sample), index) for (index, candidate) in enumerate(candidates)]
+    return candidates[min(timings)[1]]
+
+loaded_codec = None
+def get_codec():
+    global loaded_codec
+    if loaded_codec == None:
+        loaded_codec = select_codec()
+    return loaded_codec
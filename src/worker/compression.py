@@ -0,0 +1,60 @@
+import os
+import sys
+import zlib
+
+ZLIB = 'zlib'
+
+# Content smaller than this isn't worth compressing.
+MIN_COMPRESS_SIZE = 4096
+
+# Amount of a file's content to trial-compress before deciding whether to compress the whole thing.
+SAMPLE_SIZE = 64 * 1024
+
+# Only compress when the sample shrinks to this fraction of its size or smaller.
+MAX_COMPRESSED_RATIO = 0.9
+
+# Levels used to trial the sample, and to compress the real content.
+SAMPLE_LEVEL = 1
+COMPRESS_LEVEL = 6
+
+# Formats which are already compressed; no need to sample them.
+COMPRESSED_EXTENSIONS = set([
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.zip', '.jar', '.whl', '.7z', '.rar',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.mov', '.webm', '.pdf',
+])
+
+is_python_3 = (sys.version_info >= (3, 0))
+
+class Compressor:
+    def __init__(self, codec):
+        self.codec = codec
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL)
+
+    def compress(self, chunk):
+        # Python 2's zlib doesn't accept memoryviews.
+        return self.compressor.compress(chunk if is_python_3 else chunk.tobytes())
+
+    def flush(self):
+        return self.compressor.flush()
+
+def accepted_codec(args):
+    # Clients list the codecs they can decode in a request's 'compression' arg.
+    accepted = args.get('compression') or []
+    return ZLIB if ZLIB in accepted else None
+
+def choose_codec(args, sample, path=None):
+    """Returns the codec to compress a response with, or None to send it uncompressed.
+    sample is the first part of the content (or the whole thing, if small)."""
+    codec = accepted_codec(args)
+    if codec is None or len(sample) < MIN_COMPRESS_SIZE:
+        return None
+
+    if path is not None and os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return None
+
+    sample = sample[:SAMPLE_SIZE]
+    compressed_size = len(zlib.compress(sample, SAMPLE_LEVEL))
+    if compressed_size > len(sample) * MAX_COMPRESSED_RATIO:
+        return None
+
+    return codec
@@ -0,0 +1,216 @@
+import fcntl
+import hashlib
+import logging
+import os
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import msgpack
+
+# Daemon sockets and lock files are named for the worker version and Python interpreter; each combination has its own daemon.
+DAEMON_PATH = '~/.pony-ssh/daemon-'
+
+# Default time a daemon waits without any connections before exiting (seconds).
+IDLE_TIMEOUT = 600
+
+# Longest a relay waits for a newly started daemon to accept connections (seconds).
+START_TIMEOUT = 5
+
+# Unix socket paths longer than this don't fit in a sockaddr_un on every platform.
+MAX_SOCKET_PATH = 100
+
+RELAY_BUFFER_SIZE = 64 * 1024
+
+def daemon_path(worker_hash, extension):
+    key = hashlib.md5((worker_hash + ':' + sys.executable).encode('utf-8')).hexdigest()
+    return os.path.expanduser(DAEMON_PATH + key + extension)
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return sock
+    except socket.error:
+        sock.close()
+        return None
+
+def start_daemon(options):
+    command = [sys.executable, sys.argv[0], 'daemon']
+    if 'daemon-idle-timeout' in options:
+        command.append('--idle-timeout=' + options['daemon-idle-timeout'])
+
+    # Detach from the SSH session entirely, so it can close while the daemon lives on.
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+
+def connect_to_daemon(worker_hash, options):
+    path = daemon_path(worker_hash, '.sock')
+    if len(path) > MAX_SOCKET_PATH or not sys.executable:
+        return None
+
+    sock = connect(path)
+    if sock is not None:
+        return sock
+
+    start_daemon(options)
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.02)
+        sock = connect(path)
+        if sock is not None:
+            return sock
+    return None
+
+def forward_input(sock):
+    fd = sys.stdin.fileno()
+    try:
+        while True:
+            data = os.read(fd, RELAY_BUFFER_SIZE)
+            if not data:
+                break
+            sock.sendall(data)
+
+        # Client has gone; the daemon finishes up and closes the connection.
+        sock.shutdown(socket.SHUT_WR)
+    except (OSError, socket.error):
+        pass
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+def run_relay(worker_hash, mode, options, started):
+    """Passes stdin / stdout through to a worker of the given mode, hosted by the user's daemon, starting the daemon if need be.
+    Returns False (having done nothing) if the daemon can't be reached."""
+    try:
+        sock = connect_to_daemon(worker_hash, options)
+    except Exception as err:
+        logging.warning('Failed to start worker daemon: ' + str(err))
+        sock = None
+
+    if sock is None:
+        logging.warning('Worker daemon unavailable; running standalone')
+        return False
+
+    # The first message on a connection tells the daemon what to run.
+    handshake = msgpack.packb([mode, options, started])
+    sock.sendall(msgpack.packb(len(handshake)) + handshake)
+
+    # Input is forwarded on another thread; a busy worker may stop reading requests while it writes a response.
+    input_thread = threading.Thread(target=forward_input, args=(sock,))
+    input_thread.daemon = True
+    input_thread.start()
+
+    stdout_fd = sys.stdout.fileno()
+    while True:
+        data = sock.recv(RELAY_BUFFER_SIZE)
+        if not data:
+            break
+        write_all(stdout_fd, data)
+
+    sock.close()
+    return True
+
+class DaemonServer:
+    """Hosts workers for relays which connect over a unix socket, each on its own thread and channel.
+    Exits once it has had no connections for idle_timeout seconds."""
+
+    def __init__(self, listener, path, idle_timeout, modes):
+        self.listener = listener
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.modes = modes
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.last_active = time.time()
+        # Written to as each connection closes, waking the accept loop to start counting down to exit.
+        self.wake_fd, self.wake_write_fd = os.pipe()
+
+    def serve(self):
+        logging.info('Worker daemon listening on ' + self.path)
+        while True:
+            ready = select.select([self.listener, self.wake_fd], [], [], self.time_until_idle())[0]
+            if self.wake_fd in ready:
+                os.read(self.wake_fd, 4096)
+            if self.listener in ready:
+                self.accept()
+            elif self.time_until_idle() == 0:
+                break
+
+        # Stop taking new connections, but serve any which arrived in the meantime.
+        os.unlink(self.path)
+        while select.select([self.listener], [], [], 0)[0]:
+            self.accept()
+        self.listener.close()
+        logging.info('Worker daemon idle; exiting')
+
+    def time_until_idle(self):
+        with self.lock:
+            if self.connections > 0:
+                return None
+            return max(0, self.last_active + self.idle_timeout - time.time())
+
+    def accept(self):
+        sock = self.listener.accept()[0]
+        with self.lock:
+            self.connections += 1
+
+        # Not a daemon thread; the process waits for open connections to finish before exiting.
+        threading.Thread(target=self.handle_connection, args=(sock,)).start()
+
+    def handle_connection(self, sock):
+        from protocol import prepare_message_reader, set_channel, socket_channel
+
+        try:
+            set_channel(socket_channel(sock))
+            [mode, options, started] = next(prepare_message_reader())
+            run = self.modes.get(mode, None)
+            if run is None:
+                logging.warning('Unknown mode requested of worker daemon: ' + str(mode))
+            else:
+                run(options, started)
+        except StopIteration:
+            pass
+        except Exception as err:
+            logging.warning('Worker daemon connection failed: ' + str(err))
+        finally:
+            sock.close()
+            with self.lock:
+                self.connections -= 1
+                self.last_active = time.time()
+            os.write(self.wake_write_fd, b'.')
+
+def run_daemon(worker_hash, options, modes):
+    """Runs a daemon for this user and worker version, unless one is already running.
+    modes maps the names of modes relays may ask for to functions which run them; see __main__."""
+    from codec import get_codec
+
+    # Held for the daemon's lifetime; only one daemon may own the socket.
+    lock_file = open(daemon_path(worker_hash, '.lock'), 'w')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        return
+
+    # Any socket already here was left by a daemon which didn't exit cleanly.
+    path = daemon_path(worker_hash, '.sock')
+    if os.path.exists(path):
+        os.unlink(path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(16)
+
+    # Choose a codec up front, rather than racing to on the first connections.
+    get_codec()
+
+    idle_timeout = float(options.get('idle-timeout', IDLE_TIMEOUT))
+    DaemonServer(listener, path, idle_timeout, modes).serve()
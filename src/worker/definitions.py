@@ -9,6 +9,10 @@ class ParcelType:
     WARNING       = 0x05
     CHANGE_NOTICE = 0x06
 
+    # Flag set on parcels answering a request which carried a request ID.
+    # Tagged parcels are followed by the msgpack'd request ID, then the usual size and body.
+    TAGGED        = 0x80
+
 class Opcode:
     LS              = 0x01
     GET_SERVER_INFO = 0x02
@@ -19,6 +23,11 @@ class Opcode:
     RENAME          = 0x07
     EXPAND_PATH     = 0x08
     FILE_WRITE_DIFF = 0x09
+    FILE_UPLOAD     = 0x0A
+    BULK_READ       = 0x0B
+    VALIDATE        = 0x0C
+    SEARCH          = 0x0D
+    FIND            = 0x0E
     ADD_WATCH       = 0x10
     REMOVE_WATCH    = 0x11
 
@@ -26,6 +35,7 @@ class DiffAction:
     UNCHANGED = 0x00
     INSERTED  = 0x01
     REMOVED   = 0x02
+    COPIED    = 0x03 # Delta downloads only; copy a run of blocks from the client's cached copy
 
 class FileType:
     FILE      = 0x01
@@ -0,0 +1,191 @@
+import hashlib
+import sys
+import time
+import zlib
+
+from definitions import DiffAction
+
+is_python_3 = (sys.version_info >= (3, 0))
+
+ADLER_MOD = 65521
+
+# Bytes which may be scanned one at a time (in Python) looking for matches at unaligned offsets; a little under
+# half a second of CPU. Once spent, only block-aligned offsets are checked.
+ROLLING_BUDGET = 256 * 1024
+
+# A delta is abandoned, so the whole file is sent as an ordinary body, if no block matches within this many blocks
+# (or MAX_PROBE_SIZE bytes) of the start of the file; the file has too little in common with the cached copy.
+PROBE_BLOCKS = 64
+MAX_PROBE_SIZE = 4 * 1024 * 1024
+
+# Seconds (including time spent sending) after which the rest of the file is sent as literal runs, unsearched.
+TIME_LIMIT = 1.0
+
+# Longest literal run yielded in one piece.
+MAX_LITERAL_SIZE = 1024 * 1024
+
+# Size of each read from the file; the window onto it holds a few of these at most.
+READ_SIZE = 1024 * 1024
+
+class NoUsefulDelta(Exception):
+    pass
+
+def weak_checksum(block):
+    # Same as zlib.adler32; the first block is summed in C, later ones are rolled one byte at a time.
+    # Python 2's zlib only accepts strings.
+    return zlib.adler32(block if is_python_3 else bytes(block)) & 0xffffffff
+
+def strong_checksum(block):
+    return hashlib.md5(block).hexdigest()
+
+def index_blocks(blocks):
+    # Client sends [weak, strong] for each block of its cached copy, in order.
+    table = {}
+    for index, (weak, strong) in enumerate(blocks):
+        table.setdefault(weak, []).append((index, strong))
+    return table
+
+def find_block(table, weak, block):
+    candidates = table.get(weak)
+    if candidates is None:
+        return None
+
+    strong = strong_checksum(block)
+    for index, candidate_strong in candidates:
+        if candidate_strong == strong:
+            return index
+    return None
+
+class FileWindow:
+    """Bytes of an open file from start (which only moves forward) to as far as has been read, so a delta can be
+    generated without holding the whole file in memory. Stops at length, or sooner if the file shrank."""
+
+    def __init__(self, fh, length):
+        self.fh = fh
+        self.length = length
+        self.data = bytearray()
+        self.start = 0
+        self.end = 0
+
+    def fill(self, end):
+        # Reads up to end; returns how far the window actually reaches.
+        end = min(end, self.length)
+        while self.end < end:
+            chunk = self.fh.read(min(READ_SIZE, self.length - self.end))
+            if not chunk:
+                self.length = self.end
+                break
+            self.data += chunk
+            self.end += len(chunk)
+        return self.end
+
+    def slice(self, begin, end):
+        return self.data[begin - self.start:end - self.start]
+
+    def discard_before(self, offset):
+        # Deleting from the front of a bytearray is cheap, but only worth doing a read's worth at a time.
+        if offset - self.start >= READ_SIZE:
+            del self.data[:offset - self.start]
+            self.start = offset
+
+def literal_runs(window, start, end):
+    for offset in range(start, end, MAX_LITERAL_SIZE):
+        yield DiffAction.INSERTED, bytes(window.slice(offset, min(offset + MAX_LITERAL_SIZE, end)))
+
+def generate_delta(fh, length, block_size, blocks):
+    """Yields (action, action_data) pairs which rebuild the first length bytes of fh from the client's cached copy:
+    - DiffAction.INSERTED with a literal run of bytes,
+    - DiffAction.COPIED with [first block, block count] of the cached copy.
+    Raises NoUsefulDelta, before yielding anything, if no block matches near the start of the file."""
+    table = index_blocks(blocks)
+    window = FileWindow(fh, length)
+    data = window.data
+    rolling_budget = ROLLING_BUDGET
+    probe_size = min(PROBE_BLOCKS * block_size, MAX_PROBE_SIZE)
+    deadline = time.time() + TIME_LIMIT
+    matched = False
+    steps = 0
+
+    literal_start = 0
+    copy_start = None
+    copy_count = 0
+
+    position = 0
+    weak = None
+    # The window is only extended when a block runs past its end; most steps don't need to check the file.
+    while position + block_size <= window.end or window.fill(position + block_size) >= position + block_size:
+        steps += 1
+        if steps % 1024 == 0 and time.time() > deadline:
+            break
+        if not matched and position >= probe_size:
+            raise NoUsefulDelta()
+
+        if weak is None:
+            weak = weak_checksum(window.slice(position, position + block_size))
+
+        index = None
+        if weak in table:
+            index = find_block(table, weak, window.slice(position, position + block_size))
+        if index is not None:
+            matched = True
+            if literal_start < position:
+                if copy_start is not None:
+                    yield DiffAction.COPIED, [copy_start, copy_count]
+                    copy_start = None
+                for literal in literal_runs(window, literal_start, position):
+                    yield literal
+
+            if copy_start is not None and copy_start + copy_count == index:
+                copy_count += 1
+            else:
+                if copy_start is not None:
+                    yield DiffAction.COPIED, [copy_start, copy_count]
+                copy_start = index
+                copy_count = 1
+
+            position += block_size
+            literal_start = position
+            window.discard_before(literal_start)
+            weak = None
+            continue
+
+        if matched and position - literal_start >= MAX_LITERAL_SIZE:
+            # Keep the window short; send pending literals before looking any further.
+            if copy_start is not None:
+                yield DiffAction.COPIED, [copy_start, copy_count]
+                copy_start = None
+            for literal in literal_runs(window, literal_start, position):
+                yield literal
+            literal_start = position
+            window.discard_before(literal_start)
+
+        if rolling_budget > 0 and (position + block_size < window.end or window.fill(position + block_size + 1) > position + block_size):
+            # Roll the checksum forward by one byte.
+            rolling_budget -= 1
+            out_byte = data[position - window.start]
+            in_byte = data[position + block_size - window.start]
+            a = weak & 0xffff
+            b = weak >> 16
+            a = (a - out_byte + in_byte) % ADLER_MOD
+            b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+            position += 1
+        else:
+            position += block_size
+            weak = None
+
+    if not matched:
+        raise NoUsefulDelta()
+
+    if copy_start is not None:
+        yield DiffAction.COPIED, [copy_start, copy_count]
+
+    # Whatever is left (a tail shorter than a block, or everything after the time limit) is sent as it is.
+    while True:
+        end = window.fill(literal_start + MAX_LITERAL_SIZE)
+        if end <= literal_start:
+            break
+        for literal in literal_runs(window, literal_start, end):
+            yield literal
+        literal_start = end
+        window.discard_before(literal_start)
@@ -0,0 +1,347 @@
+import bisect
+import hashlib
+import heapq
+import logging
+import os
+import re
+import stat
+import threading
+import time
+from collections import OrderedDict
+
+from atomicfile import AtomicFile
+from codec import get_codec
+from definitions import FileType
+from listingcache import RACY_WINDOW, directory_key
+from statengine import get_stat_engine
+from tools import get_glob_set, process_stat, WALK_BATCH_SIZE
+
+# Indexes are stored here, one file per indexed directory, named for a hash of its path.
+INDEX_DIRECTORY = '~/.pony-ssh/file-index'
+
+# Bump when the format of index files changes; files of other versions are ignored, and rebuilt.
+INDEX_VERSION = 1
+
+# Limit on the number of entries in an index; the rest of a tree beyond this is left out.
+MAX_ENTRIES = 500000
+
+# An index queried more often than this (seconds) is only brought up to date every so often. Refreshes run in the
+# background; queries are answered from the index as it stands meanwhile.
+REFRESH_INTERVAL = 5
+
+MAX_LOADED_INDEXES = 8
+
+# Default number of results returned by FIND.
+MAX_RESULTS = 100
+
+# Version control metadata; huge, and never what a user is looking for.
+SKIPPED_DIRECTORIES = set(['.git', '.hg', '.svn'])
+
+def join_relative(rel_dir, name):
+    return name if rel_dir == '' else rel_dir + '/' + name
+
+def shared_prefix_length(a, b):
+    limit = min(len(a), len(b))
+    length = 0
+    while length < limit and a[length] == b[length]:
+        length += 1
+    return length
+
+def read_children(path):
+    """Returns [(name, type, size)] for the children of a directory, sorted by name. Symlinks have the type
+    and size of their target, with FileType.SYMLINK added; broken links are FileType.SYMLINK alone."""
+    names = sorted(os.listdir(path))
+    paths = [os.path.join(path, name) for name in names]
+    children = []
+    for name, child_path, child_stat in zip(names, paths, get_stat_engine().map(os.lstat, paths)):
+        if isinstance(child_stat, OSError):
+            continue # Vanished since listing
+
+        if stat.S_ISLNK(child_stat.st_mode):
+            try:
+                target = process_stat(os.stat(child_path))
+                children.append((name, target[0] | FileType.SYMLINK, target[3]))
+            except OSError:
+                children.append((name, FileType.SYMLINK, 0))
+        else:
+            processed = process_stat(child_stat)
+            children.append((name, processed[0], processed[3]))
+    return children
+
+def is_subsequence(query, text):
+    remaining = iter(text)
+    return all(char in remaining for char in query)
+
+def fuzzy_rank(query, path):
+    """Sort key for a path which fuzzy matches query (both lowercased); best first. Paths whose name is, starts
+    with or contains the query beat those which merely contain it elsewhere, or match it piecemeal."""
+    name = path[path.rfind('/') + 1:]
+    if name == query:
+        tier = 0
+    elif name.startswith(query):
+        tier = 1
+    elif query in name:
+        tier = 2
+    elif query in path:
+        tier = 3
+    elif is_subsequence(query, name):
+        tier = 4
+    else:
+        tier = 5
+    return (tier, len(path), path)
+
+def fuzzy_regexp(query):
+    # Matches the query's characters in order, within a line. Each gap excludes the character which ends it, so a
+    # failed match never backtracks; starting with a literal lets re skip quickly to where a match might begin.
+    pattern = re.escape(query[0])
+    for char in query[1:]:
+        escaped = re.escape(char)
+        pattern += '[^\n' + escaped + ']*' + escaped
+    return re.compile(pattern)
+
+def matching_lines(regex, text, offsets):
+    """Yields the index of each line of text in which regex matches, given the offset of each line."""
+    previous = -1
+    for match in regex.finditer(text):
+        line = bisect.bisect_right(offsets, match.start()) - 1
+        if line != previous:
+            yield line
+            previous = line
+
+class FileIndex:
+    """Names, types and sizes of everything beneath a directory, persisted between sessions. Refreshing it only
+    relists directories whose inode, mtime or ctime have changed since they were last listed; the rest are stat'd.
+    Stored as sorted, prefix-compressed paths."""
+
+    def __init__(self, root, path):
+        self.root = root
+        self.path = path
+        self.lock = threading.Lock() # Guards swapping in a refreshed index
+        self.refresh_lock = threading.Lock() # Held throughout a refresh, so only one runs at a time
+        self.directories = {} # relDir: (key, children), with relDir '' for the root; see read_children
+        self.entries = 0
+        self.truncated = False
+        self.refreshed = 0
+        self.view = None
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as fh:
+                data = fh.read()
+        except (IOError, OSError):
+            return # Not built yet; refresh() builds it from scratch.
+
+        try:
+            unpacker = get_codec().unpacker()
+            unpacker.feed(data)
+            [version, root, records] = unpacker.unpack()
+            if version != INDEX_VERSION or root != self.root:
+                return
+
+            directories = {}
+            entries = 0
+            rel_dir = ''
+            for [dir_shared, dir_suffix, key, flat_children] in records:
+                rel_dir = rel_dir[:dir_shared] + dir_suffix
+                children = []
+                name = ''
+                for i in range(0, len(flat_children), 4):
+                    shared, suffix, file_type, size = flat_children[i:i + 4]
+                    name = name[:shared] + suffix
+                    children.append((name, file_type, size))
+                directories[rel_dir] = (tuple(key) if key is not None else None, children)
+                entries += len(children)
+        except Exception as err:
+            logging.warning('Ignoring corrupt file index ' + self.path + ': ' + str(err))
+            return
+
+        self.directories = directories
+        self.entries = entries
+
+    def save(self):
+        # Each directory is stored as [shared, suffix, key, children], with the length of the prefix its path
+        # shares with the previous directory. children is a flat list of [shared, suffix, type, size] per child,
+        # with names likewise compressed against the previous child.
+        records = []
+        previous_dir = ''
+        for rel_dir in sorted(self.directories):
+            key, children = self.directories[rel_dir]
+            flat_children = []
+            previous_name = ''
+            for name, file_type, size in children:
+                shared = shared_prefix_length(previous_name, name)
+                flat_children.extend((shared, name[shared:], file_type, size))
+                previous_name = name
+
+            shared = shared_prefix_length(previous_dir, rel_dir)
+            records.append([shared, rel_dir[shared:], key, flat_children])
+            previous_dir = rel_dir
+
+        target = None
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            target = AtomicFile(self.path)
+            target.write(get_codec().packb([INDEX_VERSION, self.root, records], use_bin_type=True))
+            target.commit()
+        except (IOError, OSError, UnicodeError) as err:
+            logging.warning('Failed to save file index for ' + self.root + ': ' + str(err))
+            if target is not None:
+                target.discard()
+
+    def refresh(self):
+        """Brings the index up to date with the filesystem. Returns the number of directories relisted.
+        The caller must hold refresh_lock; the new index is only swapped in once complete."""
+        now_ns = int(time.time() * 1000000000)
+        directories = {}
+        entries = 0
+        relisted = 0
+        truncated = False
+
+        pending = ['']
+        while len(pending) > 0:
+            batch = pending[-WALK_BATCH_SIZE:]
+            del pending[-WALK_BATCH_SIZE:]
+
+            dir_stats = get_stat_engine().map(os.stat, [os.path.join(self.root, rel_dir) for rel_dir in batch])
+            for rel_dir, dir_stat in zip(batch, dir_stats):
+                if isinstance(dir_stat, OSError):
+                    continue # Vanished, or unreadable
+
+                key = directory_key(dir_stat)
+                cached = self.directories.get(rel_dir)
+                if cached is not None and cached[0] == key:
+                    children = cached[1]
+                else:
+                    try:
+                        children = read_children(os.path.join(self.root, rel_dir))
+                    except OSError:
+                        continue
+                    relisted += 1
+
+                if entries + len(children) > MAX_ENTRIES:
+                    truncated = True
+                    continue
+
+                # Directories modified very recently may change again within the same timestamp tick; relist them next time.
+                if now_ns - max(key[1], key[2]) < RACY_WINDOW * 1000000000:
+                    key = None
+
+                directories[rel_dir] = (key, children)
+                entries += len(children)
+                for name, file_type, size in children:
+                    if file_type == FileType.DIRECTORY and name not in SKIPPED_DIRECTORIES:
+                        pending.append(join_relative(rel_dir, name))
+
+        changed = relisted > 0 or len(directories) != len(self.directories)
+        with self.lock:
+            self.directories = directories
+            self.entries = entries
+            self.truncated = truncated
+            self.refreshed = time.time()
+            if changed:
+                self.view = None
+        if changed:
+            self.save()
+        return relisted
+
+    def start_refresh(self):
+        # Refreshes in a background thread, unless a refresh is already under way.
+        if not self.refresh_lock.acquire(False):
+            return
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as err:
+                logging.warning('Failed to refresh file index for ' + self.root + ': ' + str(err))
+            finally:
+                self.refresh_lock.release()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def get_view(self):
+        """Returns (files, text, offsets): [(relPath, type, size)] for every indexed non-directory, their lowercased
+        paths joined by newlines, and the offset at which each starts in the text."""
+        if self.view is None:
+            files = []
+            for rel_dir, (key, children) in self.directories.items():
+                for name, file_type, size in children:
+                    if not file_type & FileType.DIRECTORY:
+                        files.append((join_relative(rel_dir, name), file_type, size))
+
+            # Lowercasing may change the length of some (non-ASCII) paths; measure offsets after.
+            lowered = [rel_path.lower() for rel_path, file_type, size in files]
+            offsets = []
+            offset = 0
+            for rel_path in lowered:
+                offsets.append(offset)
+                offset += len(rel_path) + 1
+            self.view = (files, '\n'.join(lowered), offsets)
+        return self.view
+
+    def find(self, args):
+        """Answers a FIND request: { results: [[relPath, type, size]], files, truncated }. Results are the best
+        maxResults files matching args['query'] (fuzzy), or args['glob'], and none of args['excludes']."""
+        if self.refreshed == 0 and len(self.directories) == 0:
+            # Nothing to answer from yet; build the index now.
+            with self.refresh_lock:
+                if self.refreshed == 0:
+                    self.refresh()
+        elif time.time() - self.refreshed >= REFRESH_INTERVAL:
+            self.start_refresh()
+
+        with self.lock:
+            files, text, offsets = self.get_view()
+            truncated = self.truncated
+
+        excludes = get_glob_set(args.get('excludes', []))
+        def is_excluded(rel_path):
+            # Excluding a directory excludes everything in it.
+            parts = rel_path.split('/')
+            return any(excludes.match('/'.join(parts[:depth])) for depth in range(1, len(parts) + 1))
+
+        max_results = args.get('maxResults', MAX_RESULTS)
+        if 'glob' in args:
+            # As in VS Code, globs without a path separator match files at any depth.
+            glob = args['glob'] if '/' in args['glob'] else '**/' + args['glob']
+            matcher = get_glob_set([glob])
+            candidates = (entry for entry in files if matcher.match(entry[0]) and (len(excludes.globs) == 0 or not is_excluded(entry[0])))
+            results = heapq.nsmallest(max_results, candidates, key=lambda entry: (len(entry[0]), entry[0]))
+        else:
+            query = ''.join(args.get('query', '').lower().split())
+            if query == '':
+                candidates = iter(files)
+            else:
+                candidates = (files[line] for line in matching_lines(fuzzy_regexp(query), text, offsets))
+            if len(excludes.globs) > 0:
+                candidates = (entry for entry in candidates if not is_excluded(entry[0]))
+            results = heapq.nsmallest(max_results, candidates, key=lambda entry: fuzzy_rank(query, entry[0].lower()))
+
+        return {
+            'results': [list(entry) for entry in results],
+            'files': len(files),
+            'truncated': truncated,
+        }
+
+def index_path(root):
+    key = root if isinstance(root, bytes) else root.encode('utf-8', 'surrogateescape')
+    return os.path.join(os.path.expanduser(INDEX_DIRECTORY), hashlib.md5(key).hexdigest() + '.idx')
+
+loaded_file_indexes = OrderedDict()
+file_indexes_lock = threading.Lock()
+def get_file_index(root):
+    """Returns the index of a directory, loading it from disk if need be. The most recently used few are kept in memory."""
+    root = os.path.abspath(root)
+    with file_indexes_lock:
+        index = loaded_file_indexes.pop(root, None)
+        if index is None:
+            index = FileIndex(root, index_path(root))
+            index.load()
+        loaded_file_indexes[root] = index
+        while len(loaded_file_indexes) > MAX_LOADED_INDEXES:
+            loaded_file_indexes.popitem(last=False)
+        return index
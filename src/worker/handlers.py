@@ -1,17 +1,38 @@
-from collections import deque
 import binascii
 import hashlib
+import itertools
 import logging
 import os
-import shutil
 import stat
-import tempfile
+import threading
+import time
 from io import open
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from atomicfile import AtomicFile
+from codec import get_codec
 from definitions import Opcode, ParcelType, DiffAction
-from errors import Error, CodedError
+from delta import NoUsefulDelta, generate_delta
+from errors import Error, CodedError, process_error
+from fileindex import get_file_index
 from tools import process_stat
-from protocol import send_response_header, send_parcel, send_empty_parcel, send_error
+from compression import Compressor, SAMPLE_SIZE, accepted_codec, choose_codec
+from hashindex import get_hash_index, stat_key
+from listingcache import get_listing_cache
+from prefetch import PrefetchBudget, explore_directory
+from search import TextSearch
+from statengine import get_stat_engine
+from protocol import get_channel, standard_channel, send_response_header, send_streaming_header, send_parcel, send_empty_parcel, send_error, send_file_body, send_file_content, send_compressible_response, BODY_CHUNK_SIZE, MAX_CONCURRENT_REQUESTS
+
+# Maximum number of received upload chunks waiting to be written to disk.
+UPLOAD_QUEUE_LENGTH = 4
+
+# Size of the buffer files are hashed and copied through, rather than read whole.
+COPY_BUFFER_SIZE = 1024 * 1024
 
 def handle_expand_path(args):
     path = os.path.expanduser(args['path'])
@@ -27,48 +48,41 @@ def handle_ls(args):
     selfStat = os.stat(base)
 
     result = { 'stat': process_stat(selfStat) }
-    if not stat.S_ISDIR(selfStat[stat.ST_MODE]):
+    if not stat.S_ISDIR(selfStat.st_mode):
         send_response_header(result)
         return
 
-    dirs = {}
-    dirLimit = 25
-    entryLimit = 2000
-    explore = deque(['.'])
-    while len(explore) > 0 and dirLimit > 0 and entryLimit > 0:
-        dirLimit -= 1
-
-        relPath = explore.popleft()
-        absPath = base if relPath == '.' else os.path.join(base, relPath)
+    # Also list as many subdirectories as the client's prefetch budget allows, to save it asking.
+    budget = PrefetchBudget(args.get('prefetch'))
+    unexplored = []
+    explorer = explore_directory(base, selfStat, budget, unexplored)
+    if args.get('stream'):
+        stream_listing(result, explorer, unexplored)
+        return
 
-        try:
-            children = {}
-            for childName in os.listdir(absPath):
-                entryLimit -= 1
-                if entryLimit < 0 and len(dirs) > 0:
-                    children = None
-                    break
-
-                child_path = os.path.join(absPath, childName)
-                try:
-                    childStat = os.stat(child_path)
-                    children[childName] = process_stat(childStat)
-
-                    isDir = stat.S_ISDIR(childStat[stat.ST_MODE])
-                    if isDir and len(explore) < dirLimit:
-                        explore.append(os.path.join(relPath, childName))
-                except OSError as err:
-                    logging.warning('Skipping ' + child_path + ': ' + str(err))
-
-            if children is not None:
-                dirs[relPath] = children
-        except OSError as err:
-            logging.warning('Error: ' + str(err))
-            if len(dirs) == 0:
-                raise err # Only raise read errors on the first item.
+    dirs = {}
+    for relPath, children in explorer:
+        dirs[relPath] = children
 
     result['dirs'] = dirs
-    send_response_header(result)
+    result['unexplored'] = unexplored
+    send_compressible_response(get_codec().pack_listing(result), args)
+
+def stream_listing(result, explorer, unexplored):
+    # The header holds the requested directory's listing, and is sent as soon as it's read. Each prefetched
+    # subdirectory follows in a BODY parcel, then one with the unexplored list, then ENDOFBODY. Every parcel is
+    # part of an LS response; merged together, they're the same as a response sent in one piece (less 'streaming').
+    codec = get_codec()
+    relPath, children = next(explorer)
+    result['dirs'] = { relPath: children }
+    result['streaming'] = True
+    send_parcel(ParcelType.HEADER, codec.pack_listing(result))
+
+    for relPath, children in explorer:
+        send_parcel(ParcelType.BODY, codec.pack_listing({ 'dirs': { relPath: children } }))
+
+    send_parcel(ParcelType.BODY, codec.pack_listing({ 'unexplored': unexplored }))
+    send_parcel(ParcelType.ENDOFBODY, b'')
 
 def handle_get_server_info(args):
     settingsPath = os.path.expanduser('~/.pony-ssh/')
@@ -89,80 +103,234 @@ def handle_get_server_info(args):
         with open(cacheKeyFile, 'wb') as keyFileHandle:
             keyFileHandle.write(cacheKey)
 
+    # Seconds from the worker (or its relay) starting up to being ready for requests; see __main__.
+    startup_time = get_channel().startup_time
+
     send_response_header({
         'home': os.path.expanduser('~'),
         'cacheKey': cacheKey,
-        'newCacheKey': cacheKeyIsNew
+        'newCacheKey': cacheKeyIsNew,
+        'maxConcurrentRequests': MAX_CONCURRENT_REQUESTS,
+        'codec': get_codec().name,
+        'startupTime': None if startup_time is None else int(startup_time * 1000),
+        'daemon': get_channel() is not standard_channel,
+        'listingCache': get_listing_cache().stats(),
     })
 
+def hash_file_contents(fh):
+    # Hash in fixed-size pieces through one buffer, rather than reading the whole file into memory.
+    hasher = hashlib.md5()
+    buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    while True:
+        count = fh.readinto(buffer)
+        if not count:
+            break
+        hasher.update(buffer[:count])
+    return hasher.hexdigest()
+
+def send_file_delta(fh, file_stat, known_hash, args):
+    """Client supplied block signatures of its (stale) cached copy; send instructions to rebuild the file from it.
+    Returns False, having sent nothing, if the file has too little in common with the cached copy for that to help.
+    known_hash must be the hash of the file's content, and fh at the start of the file."""
+    block_size = args['blockSize']
+    if block_size <= 0:
+        raise CodedError(Error.EINVAL, 'Invalid block size: ' + str(block_size))
+
+    length = file_stat.st_size
+    actions = generate_delta(fh, length, block_size, args['blocks'])
+    try:
+        first_action = next(actions)
+    except NoUsefulDelta:
+        return False
+
+    send_response_header({'length': length, 'delta': True, 'hash': known_hash})
+
+    # Body parcels contain msgpack'd flat arrays of [ action, data, action, data, ... ], like FILE_WRITE_DIFF.
+    batch = []
+    batch_size = 0
+    for action, action_data in itertools.chain([first_action], actions):
+        batch.append(action)
+        batch.append(action_data)
+        batch_size += len(action_data) if action == DiffAction.INSERTED else 8
+        if batch_size >= BODY_CHUNK_SIZE:
+            send_parcel(ParcelType.BODY, get_codec().packb(batch, use_bin_type=True))
+            batch = []
+            batch_size = 0
+
+    if len(batch) > 0:
+        send_parcel(ParcelType.BODY, get_codec().packb(batch, use_bin_type=True))
+    send_parcel(ParcelType.ENDOFBODY, b'')
+    return True
+
+def find_file_hash(fh, file_stat, hash_index, force=False):
+    """Returns the hash of an open file's content if it's known, or worth finding (ie; the file hasn't changed
+    since it was last hashed, or force is set), otherwise None. Leaves fh at the start of the file."""
+    known_hash, changed = hash_index.lookup(file_stat)
+    if known_hash is None and (force or not changed):
+        known_hash = hash_file_contents(fh)
+        if stat_key(os.fstat(fh.fileno())) == stat_key(file_stat):
+            hash_index.store(file_stat, known_hash)
+        fh.seek(0, 0)
+    return known_hash
+
 def handle_file_read(args):
     path = os.path.expanduser(args['path'])
+    hash_index = get_hash_index()
 
     # Open the file before sending a response header
-    fh = open(path, 'rb')
-
-    # If a hash has been supplied, check if it matches. IF so, shortcut download.
-    if 'cachedHash' in args:
-        hash = hashlib.md5(fh.read()).hexdigest()
-        if hash == args['cachedHash']:
-            send_response_header({'hashMatch': True})
+    with open(path, 'rb') as fh:
+        file_stat = os.fstat(fh.fileno())
+
+        # If a hash has been supplied, check if it matches. IF so, shortcut download.
+        # Files known to have changed since they were last hashed are sent without checking; hashed as they go.
+        if 'cachedHash' in args:
+            known_hash = find_file_hash(fh, file_stat, hash_index)
+            if known_hash == args['cachedHash']:
+                send_response_header({'hashMatch': True})
+                return
+        else:
+            known_hash = hash_index.lookup(file_stat)[0]
+
+        length = file_stat.st_size
+        if 'blocks' in args and length > 0:
+            # The delta's header carries the hash of the content it rebuilds, so find that first.
+            if known_hash is None:
+                known_hash = find_file_hash(fh, file_stat, hash_index, force=True)
+            if send_file_delta(fh, file_stat, known_hash, args):
+                return
+            fh.seek(0, 0)
+
+        codec = None
+        if length > 0 and accepted_codec(args) is not None:
+            codec = choose_codec(args, fh.read(SAMPLE_SIZE), path)
+            fh.seek(0, 0)
+
+        header = {'length': length}
+        if codec is not None:
+            header['compression'] = codec
+        send_response_header(header)
+
+        if length == 0:
             return
-        fh.seek(0, 0)
 
-    length = os.path.getsize(path)
-    send_response_header({'length': length})
+        hasher = hashlib.md5() if known_hash is None else None
+        compressor = Compressor(codec) if codec is not None else None
+        if not send_file_body(fh, length, hasher, compressor):
+            return # The client was sent an error; nothing it received is worth a hash
+
+        if hasher is not None and stat_key(os.fstat(fh.fileno())) == stat_key(file_stat):
+            hash_index.store(file_stat, hasher.hexdigest())
+
+def send_bulk_file(index, entry, hash_index):
+    # Anything that can go wrong before reading the file's content is checked before its { index, length } is sent.
+    path = os.path.expanduser(entry['path'])
+    with open(path, 'rb') as fh:
+        file_stat = os.fstat(fh.fileno())
+        if not stat.S_ISREG(file_stat.st_mode):
+            raise CodedError(Error.EISDIR if stat.S_ISDIR(file_stat.st_mode) else Error.EINVAL, 'Not a regular file')
+
+        if 'cachedHash' in entry:
+            known_hash = find_file_hash(fh, file_stat, hash_index)
+            if known_hash == entry['cachedHash']:
+                send_parcel(ParcelType.BODY, get_codec().packb({'index': index, 'hashMatch': True}))
+                return
+        else:
+            known_hash = hash_index.lookup(file_stat)[0]
 
-    if length == 0:
-        return
+        length = file_stat.st_size
+        send_parcel(ParcelType.BODY, get_codec().packb({'index': index, 'length': length}))
 
-    chunkSize = 200 * 1024
-    while True:
-        chunk = fh.read(chunkSize)
-        if not chunk:
-            break
-        send_parcel(ParcelType.BODY, chunk)
+        hasher = hashlib.md5() if known_hash is None else None
+        if not send_file_content(fh, length, hasher, exact=True):
+            raise CodedError(Error.EIO, 'File shrank while being read')
+
+        if hasher is not None and stat_key(os.fstat(fh.fileno())) == stat_key(file_stat):
+            hash_index.store(file_stat, hasher.hexdigest())
 
-    fh.close()
+def handle_bulk_read(args):
+    # Reads several files in one response. After a streaming header, each file gets a BODY parcel describing it,
+    # like a FILE_READ header plus its 'index' in args['files']: { index, hashMatch }, { index, length } followed
+    # by exactly length bytes of content in BODY parcels, or { index, code, error } if it couldn't be read.
+    # If reading fails part way through, the content is padded out to length with zeros, and followed by
+    # { index, code, error }; the content must then be discarded. ENDOFBODY follows the last file.
+    files = args['files']
+    hash_index = get_hash_index()
+    send_streaming_header({'count': len(files)})
+
+    for index, entry in enumerate(files):
+        try:
+            send_bulk_file(index, entry, hash_index)
+        except CodedError as err:
+            send_parcel(ParcelType.BODY, get_codec().packb({'index': index, 'code': err.code, 'error': err.message}))
+        except (IOError, OSError) as err:
+            send_parcel(ParcelType.BODY, get_codec().packb({'index': index, 'code': process_error(err.errno), 'error': err.strerror}))
+        except Exception as err:
+            # eg; a malformed entry. Fail just this file, not the rest of the batch.
+            logging.warning(err)
+            send_parcel(ParcelType.BODY, get_codec().packb({'index': index, 'code': Error.EINVAL, 'error': str(err)}))
 
     send_parcel(ParcelType.ENDOFBODY, b'')
 
+def copy_file_range(source, offset, length, target, buffer):
+    # Copies length bytes of source from offset to target, through buffer; raises if source ends first.
+    source.seek(offset)
+    while length > 0:
+        count = source.readinto(buffer[:min(length, len(buffer))])
+        if not count:
+            raise CodedError(Error.EIO, 'File shrank while being updated')
+        target.write(buffer[:count])
+        length -= count
+
 def handle_file_write_diff(args):
     path = os.path.expanduser(args['path'])
 
     if not os.path.exists(path):
         raise OSError(Error.ENOENT, 'File not found')
 
-    with open(path, 'r', encoding='latin-1') as fh:
-        original_data = bytearray(fh.read(), 'latin-1')
-
-    original_hash = hashlib.md5(original_data).hexdigest()
-    if original_hash != args['hashBefore']:
-        raise CodedError(Error.EIO, 'File hash does not match client cached value: ' + args['hashBefore'] + ' vs ' + original_hash)
-
-    # Apply diff; comes in as a flat array containing pairs; action, action data.
-    updated_data = bytearray()
-    read_cursor = 0
-    diff = args['diff']
-
-    for i in range(0, len(diff), 2):
-        action = diff[i]
-        action_data = diff[i + 1]
-
-        if action == DiffAction.INSERTED:
-            updated_data.extend(bytearray(action_data, 'latin-1')) # Action data contains new data inserted
-        elif action == DiffAction.REMOVED:
-            read_cursor += action_data # Action data contains number of bytes to remove
-        else:
-            # Action data contains number of bytes to copy from original
-            updated_data.extend(original_data[read_cursor:read_cursor+action_data])
-            read_cursor += action_data
-
-    updated_hash = hashlib.md5(updated_data).hexdigest()
-    if updated_hash != args['hashAfter']:
-        raise CodedError(Error.EINVAL, 'File hash after changes applied does not match expected')
-
-    with open(path, 'wb') as fh:
-        fh.write(updated_data)
+    # The original is read twice, through one fixed-size buffer; once to check its hash, then again to copy
+    # unchanged runs from. Neither pass holds the whole file in memory.
+    with open(path, 'rb') as fh:
+        original_key = stat_key(os.fstat(fh.fileno()))
+        original_hash = hash_file_contents(fh)
+        if original_hash != args['hashBefore']:
+            raise CodedError(Error.EIO, 'File hash does not match client cached value: ' + args['hashBefore'] + ' vs ' + original_hash)
+
+        # Apply diff; comes in as a flat array containing pairs; action, action data.
+        # Updated content is streamed to a temporary file (and hashed) as it is built.
+        updated = AtomicFile(path)
+        try:
+            if stat_key(os.fstat(fh.fileno())) != original_key:
+                raise CodedError(Error.EIO, 'File changed while being updated')
+
+            buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+            read_cursor = 0
+            diff = args['diff']
+
+            for i in range(0, len(diff), 2):
+                action = diff[i]
+                action_data = diff[i + 1]
+
+                if action == DiffAction.INSERTED:
+                    # Action data contains new data inserted; binary, or a latin-1 string from older clients.
+                    if not isinstance(action_data, bytes):
+                        action_data = action_data.encode('latin-1')
+                    updated.write(action_data)
+                elif action == DiffAction.REMOVED:
+                    read_cursor += action_data # Action data contains number of bytes to remove
+                else:
+                    # Action data contains number of bytes to copy from original
+                    copy_file_range(fh, read_cursor, action_data, updated, buffer)
+                    read_cursor += action_data
+
+            if updated.hexdigest() != args['hashAfter']:
+                raise CodedError(Error.EINVAL, 'File hash after changes applied does not match expected')
+            if stat_key(os.fstat(fh.fileno())) != original_key:
+                raise CodedError(Error.EIO, 'File changed while being updated')
+
+            get_hash_index().store(updated.commit(), args['hashAfter'])
+        except BaseException:
+            updated.discard()
+            raise
 
     send_response_header({})
 
@@ -175,12 +343,175 @@ def handle_file_write(args):
     elif not alreadyExists and not args['create']:
         raise OSError(Error.ENOENT, 'File not found')
 
-    fh = open(path, 'wb')
-    fh.write(args['data'])
-    fh.close()
+    # Written in place, so the file keeps its inode; record its new hash, or a later FILE_READ with it won't match.
+    with open(path, 'wb') as fh:
+        fh.write(args['data'])
+        fh.flush()
+        file_stat = os.fstat(fh.fileno())
+    get_hash_index().store(file_stat, hashlib.md5(args['data']).hexdigest())
 
     send_response_header({})
 
+def read_upload_chunks(message_reader):
+    # Upload bodies follow the request as a series of binary messages, terminated by an empty one.
+    while True:
+        chunk = next(message_reader)
+        if not isinstance(chunk, bytes):
+            raise CodedError(Error.EINVAL, 'Expected binary upload chunk, got: ' + str(type(chunk)))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def write_upload_chunks(target, chunks, errors):
+    # Runs on its own thread, so disk writes overlap with reading the next chunks from the client.
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        if len(errors) == 0:
+            try:
+                target.write(chunk)
+            except BaseException as err:
+                errors.append(err)
+
+def handle_file_upload(args, message_reader):
+    path = os.path.expanduser(args['path'])
+
+    target = None
+    try:
+        alreadyExists = os.path.exists(path)
+        if alreadyExists and not args['overwrite']:
+            raise OSError(Error.EEXIST, 'File already exists')
+        elif not alreadyExists and not args['create']:
+            raise OSError(Error.ENOENT, 'File not found')
+
+        target = AtomicFile(path)
+    finally:
+        if target is None:
+            # Keep the message stream in sync, even when refusing the upload.
+            for chunk in read_upload_chunks(message_reader):
+                pass
+
+    try:
+        chunks = queue.Queue(UPLOAD_QUEUE_LENGTH)
+        errors = []
+        writer = threading.Thread(target=write_upload_chunks, args=(target, chunks, errors))
+        writer.start()
+        try:
+            for chunk in read_upload_chunks(message_reader):
+                chunks.put(chunk)
+        finally:
+            chunks.put(None)
+            writer.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+        hash = target.hexdigest()
+        if 'hash' in args and hash != args['hash']:
+            raise CodedError(Error.EIO, 'Uploaded file hash does not match: ' + args['hash'] + ' vs ' + hash)
+
+        file_stat = target.commit()
+    except BaseException:
+        target.discard()
+        raise
+
+    get_hash_index().store(file_stat, hash)
+    send_response_header({'hash': hash})
+
+def read_validate_batches(message_reader):
+    # Entries to validate follow the request as a series of arrays, terminated by an empty one.
+    while True:
+        batch = next(message_reader)
+        if not isinstance(batch, list):
+            raise CodedError(Error.EINVAL, 'Expected array of entries to validate, got: ' + str(type(batch)))
+        if len(batch) == 0:
+            return
+        yield batch
+
+def check_cached_entry(entry, entry_stat, hash_index, racy_time):
+    """Returns None if a client's cached entry [ path, size, mtime, hash? ] is still valid, otherwise an item for the
+    VALIDATE response: [ stat ] if it has changed, or [ stat, True ] if only its metadata has."""
+    if isinstance(entry_stat, OSError):
+        return [None]
+
+    processed = process_stat(entry_stat)
+    if processed[3] != entry[1]:
+        return [processed]
+
+    # Files changed within the same second as the client cached them may have kept the same size and mtime.
+    cached_hash = entry[3] if len(entry) > 3 else None
+    ambiguous = (processed[1] != entry[2] or processed[1] >= racy_time)
+    if not ambiguous:
+        return None
+    if cached_hash is None or not stat.S_ISREG(entry_stat.st_mode):
+        return [processed]
+
+    try:
+        with open(os.path.expanduser(entry[0]), 'rb') as fh:
+            file_stat = os.fstat(fh.fileno())
+            if find_file_hash(fh, file_stat, hash_index, force=True) != cached_hash:
+                return [process_stat(file_stat)]
+    except (IOError, OSError):
+        return [None]
+
+    return None if processed[1] == entry[2] else [processed, True]
+
+def handle_validate(args, message_reader):
+    # Checks whether the client's cached files and listings are still current. Entries arrive in batches after the
+    # request (see read_validate_batches); each is [ path, size, mtime, hash? ], with mtime in seconds as in stats.
+    # Stats are compared first, and content hashed only when they can't tell. After a streaming header, each BODY
+    # parcel lists the entries in a batch which are no longer valid, as [ index, stat, (metadataOnly) ]; stat is nil
+    # for entries which have gone. Indexes count from the first entry of the first batch. ENDOFBODY ends the response.
+    send_streaming_header({})
+
+    hash_index = get_hash_index()
+    stat_engine = get_stat_engine()
+    batches = read_validate_batches(message_reader)
+    try:
+        index = 0
+        for batch in batches:
+            racy_time = int(time.time()) - 1
+            stats = stat_engine.map(os.stat, [os.path.expanduser(entry[0]) for entry in batch])
+
+            invalid = []
+            for entry, entry_stat in zip(batch, stats):
+                result = check_cached_entry(entry, entry_stat, hash_index, racy_time)
+                if result is not None:
+                    invalid.append([index] + result)
+                index += 1
+
+            if len(invalid) > 0:
+                send_parcel(ParcelType.BODY, get_codec().packb(invalid))
+    finally:
+        # Keep the message stream in sync, even if validation fails part way.
+        for batch in batches:
+            pass
+
+    send_parcel(ParcelType.ENDOFBODY, b'')
+
+def handle_search(args):
+    # Streams matches back as they're found. After a streaming header, each BODY parcel holds a batch of them:
+    # { matches: [[relPath, [[line, column, length, preview, previewColumn], ...]], ...] }, with paths relative
+    # to args['path']. A final BODY parcel summarises the search: { files, bytes, limitHit }, then ENDOFBODY.
+    search = TextSearch(os.path.expanduser(args['path']), args)
+    send_streaming_header({})
+
+    codec = get_codec()
+    for results in search.run():
+        send_parcel(ParcelType.BODY, codec.packb({'matches': results}))
+
+    send_parcel(ParcelType.BODY, codec.packb({'files': search.files, 'bytes': search.bytes, 'limitHit': search.limit_hit}))
+    send_parcel(ParcelType.ENDOFBODY, b'')
+
+def handle_find(args):
+    # Finds files beneath a directory by name, from an index of it kept under ~/.pony-ssh; see FileIndex.find.
+    path = os.path.expanduser(args['path'])
+    if not os.path.isdir(path):
+        send_error(Error.ENOTDIR, 'Not a directory')
+    else:
+        send_response_header(get_file_index(path).find(args))
+
 def handle_mkdir(args):
     path = os.path.expanduser(args['path'])
     os.mkdir(path)
@@ -189,6 +520,7 @@ def handle_mkdir(args):
 def handle_delete(args):
     path = os.path.expanduser(args['path'])
     if os.path.isdir(path) and not os.path.islink(path):
+        import shutil # Rarely needed; not worth importing on every worker start.
         shutil.rmtree(path)
     else:
         os.remove(path)
@@ -217,4 +549,13 @@ message_handlers = {
     Opcode.RENAME:          handle_rename,
     Opcode.EXPAND_PATH:     handle_expand_path,
     Opcode.FILE_WRITE_DIFF: handle_file_write_diff,
+    Opcode.BULK_READ:       handle_bulk_read,
+    Opcode.SEARCH:          handle_search,
+    Opcode.FIND:            handle_find,
+}
+
+# Handlers which read further messages (eg; upload chunks) from the message stream after their request.
+stream_handlers = {
+    Opcode.FILE_UPLOAD:     handle_file_upload,
+    Opcode.VALIDATE:        handle_validate,
 }
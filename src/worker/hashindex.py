@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import time
+
+# Imported on first use, rather than slowing down every worker start; see load_sqlite.
+sqlite3 = None
+
+INDEX_PATH = '~/.pony-ssh/hash-index.db'
+MAX_ENTRIES = 50000
+
+# Only record a hit if the entry hasn't been used for this long; saves a write on every lookup.
+TOUCH_INTERVAL = 60
+
+# Check for entries to evict once every this many inserts.
+EVICT_INTERVAL = 100
+
+# Files and directories modified this recently (seconds) can't be trusted to be unchanged while their stat is; a
+# further change within the same timestamp tick would go unnoticed on filesystems with coarse timestamps.
+RACY_WINDOW = 2
+
+def signed_64(value):
+    # SQLite integers are signed; device and inode numbers may not fit without wrapping.
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def stat_nanoseconds(file_stat, field):
+    ns = getattr(file_stat, field + '_ns', None)
+    if ns is None:
+        ns = int(getattr(file_stat, field) * 1000000000)
+    return ns
+
+def stat_key(file_stat):
+    return (
+        signed_64(file_stat.st_dev),
+        signed_64(file_stat.st_ino),
+        file_stat.st_size,
+        stat_nanoseconds(file_stat, 'st_mtime'),
+        stat_nanoseconds(file_stat, 'st_ctime'),
+    )
+
+def load_sqlite():
+    global sqlite3
+    if sqlite3 is None:
+        import sqlite3 as module
+        sqlite3 = module
+    return sqlite3
+
+class HashIndex:
+    """Persistent map of file identity + metadata to content hash, shared between worker processes.
+    Entries are keyed by (device, inode); an entry only matches while size, mtime and ctime are unchanged."""
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.inserts = 0
+        self.disabled = False
+
+    def available(self):
+        if not self.disabled and sqlite3 is None:
+            try:
+                load_sqlite()
+            except ImportError:
+                self.disabled = True
+        return not self.disabled
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute('CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, ino INTEGER, size INTEGER, ' +
+                'mtime_ns INTEGER, ctime_ns INTEGER, hash TEXT, used REAL, PRIMARY KEY (dev, ino))')
+            db.execute('CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)')
+            db.commit()
+            self.local.db = db
+        return db
+
+    def lookup(self, file_stat):
+        """Returns (hash, changed). hash is None unless the file is indexed and unchanged since.
+        changed is True if the file is indexed, but has been modified since it was hashed."""
+        if not self.available():
+            return None, False
+
+        key = stat_key(file_stat)
+        try:
+            db = self.connection()
+            row = db.execute('SELECT size, mtime_ns, ctime_ns, hash, used FROM hashes WHERE dev = ? AND ino = ?', key[:2]).fetchone()
+            if row is None:
+                return None, False
+            if tuple(row[:3]) != key[2:]:
+                return None, True
+
+            now = time.time()
+            if now - row[4] > TOUCH_INTERVAL:
+                db.execute('UPDATE hashes SET used = ? WHERE dev = ? AND ino = ?', (now,) + key[:2])
+                db.commit()
+            return row[3], False
+        except sqlite3.Error as err:
+            self.on_error(err)
+            return None, False
+
+    def store(self, file_stat, hash):
+        """Records the hash of a file's content, as it was when stat'd. Files modified within RACY_WINDOW are recorded
+        without a hash; they look unchanged to lookup, so the next hash check re-hashes (and stores) them."""
+        if not self.available():
+            return
+
+        key = stat_key(file_stat)
+        now = time.time()
+        if int(now * 1000000000) - max(key[3], key[4]) < RACY_WINDOW * 1000000000:
+            hash = None
+
+        try:
+            db = self.connection()
+            db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)', key + (hash, now))
+            db.commit()
+
+            self.inserts += 1
+            if self.inserts % EVICT_INTERVAL == 1:
+                self.evict(db)
+        except sqlite3.Error as err:
+            self.on_error(err)
+
+    def evict(self, db):
+        # Trim the least recently used entries, leaving some headroom before the next eviction.
+        count = db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+        if count > self.max_entries:
+            excess = count - int(self.max_entries * 0.9)
+            db.execute('DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY used LIMIT ?)', (excess,))
+            db.commit()
+
+    def on_error(self, err):
+        # The index is only an optimisation; never let it break file access.
+        logging.warning('Hash index error: ' + str(err))
+        if isinstance(err, sqlite3.DatabaseError) and not isinstance(err, sqlite3.OperationalError):
+            self.disabled = True
+
+loaded_hash_index = None
+def get_hash_index():
+    global loaded_hash_index
+    if loaded_hash_index == None:
+        loaded_hash_index = HashIndex(os.path.expanduser(INDEX_PATH), MAX_ENTRIES)
+    return loaded_hash_index
@@ -12,6 +12,8 @@ class Libc:
     IN_DELETE      = 0x00000200 # File deleted
     IN_DELETE_SELF = 0x00000400 # Watched directory deleted
     IN_MOVE_SELF   = 0x00000800 # Watched directory moved
+    IN_IGNORED     = 0x00008000 # Watch removed; explicitly, or because its directory was deleted
+    IN_ISDIR       = 0x40000000 # Subject of the event is a directory
 
     IN_ALL_CHANGES = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | 
         IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from hashindex import RACY_WINDOW, stat_nanoseconds
+
+MAX_DIRECTORIES = 5000
+
+# Limit on the total number of children held across all cached directories; roughly bounds memory use.
+MAX_ENTRIES = 100000
+
+def directory_key(dir_stat):
+    return (dir_stat.st_ino, stat_nanoseconds(dir_stat, 'st_mtime'), stat_nanoseconds(dir_stat, 'st_ctime'))
+
+class ListingCache:
+    """Children of recently listed directories, keyed by path, with least recently used entries evicted first.
+    An entry is only reused while the directory's inode, mtime and ctime are unchanged; ie; nothing has been
+    added, removed or renamed in it since. Changes to the content of its children go unnoticed."""
+
+    def __init__(self, max_directories, max_entries):
+        self.max_directories = max_directories
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.directories = OrderedDict()
+        self.entry_count = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, path):
+        """Returns (key, children). children is None unless cached and still valid; if not, pass key to store()
+        once the directory has been read. Raises OSError if the directory can't be stat'd."""
+        key = directory_key(os.stat(path))
+        with self.lock:
+            cached = self.directories.pop(path, None)
+            if cached is not None and cached[0] == key:
+                self.directories[path] = cached
+                self.hits += 1
+                return key, cached[1]
+
+            if cached is not None:
+                self.entry_count -= len(cached[1])
+            self.misses += 1
+            return key, None
+
+    def store(self, path, key, children):
+        # key should come from stat'ing the directory before reading it. Directories modified within RACY_WINDOW
+        # aren't cached.
+        now_ns = int(time.time() * 1000000000)
+        if now_ns - max(key[1], key[2]) < RACY_WINDOW * 1000000000 or len(children) > self.max_entries:
+            return
+
+        with self.lock:
+            previous = self.directories.pop(path, None)
+            if previous is not None:
+                self.entry_count -= len(previous[1])
+
+            self.directories[path] = (key, children)
+            self.entry_count += len(children)
+
+            while len(self.directories) > self.max_directories or self.entry_count > self.max_entries:
+                evicted = self.directories.popitem(last=False)[1]
+                self.entry_count -= len(evicted[1])
+
+    def stats(self):
+        with self.lock:
+            return { 'hits': self.hits, 'misses': self.misses, 'directories': len(self.directories), 'entries': self.entry_count }
+
+loaded_listing_cache = None
+def get_listing_cache():
+    global loaded_listing_cache
+    if loaded_listing_cache == None:
+        loaded_listing_cache = ListingCache(MAX_DIRECTORIES, MAX_ENTRIES)
+    return loaded_listing_cache
@@ -0,0 +1,113 @@
+import heapq
+import logging
+import os
+import time
+
+from definitions import FileType
+from listingcache import directory_key, get_listing_cache
+from tools import get_glob_set, process_stat, stat_children
+
+# Default budget for listing subdirectories alongside the one requested by LS; clients may
+# override any of these with a 'prefetch' arg of the same shape. It may also hold 'excludes';
+# globs for directories (relative to the one requested) never to prefetch.
+DEFAULT_BUDGET = {
+    'ms': 1000,          # Wall-clock time spent listing
+    'entries': 2000,     # Children listed, across all directories
+    'bytes': 256 * 1024, # Estimated size of the listings in the response
+    'directories': 25,   # Directories listed, including the requested one
+}
+
+# Estimated size of a listing entry in a response, beyond the length of its name.
+ENTRY_SIZE = 16
+
+# Directories which are rarely browsed, but are often huge. Never prefetched, nor are dot-directories.
+SKIPPED_DIRECTORIES = set(['node_modules', 'bower_components', '__pycache__', 'site-packages'])
+
+class PrefetchBudget:
+    def __init__(self, budget):
+        budget = budget or {}
+        self.deadline = time.time() + budget.get('ms', DEFAULT_BUDGET['ms']) / 1000.0
+        self.entries = budget.get('entries', DEFAULT_BUDGET['entries'])
+        self.bytes = budget.get('bytes', DEFAULT_BUDGET['bytes'])
+        self.directories = budget.get('directories', DEFAULT_BUDGET['directories'])
+        self.excludes = get_glob_set(budget.get('excludes', []))
+
+    def exhausted(self):
+        return self.entries <= 0 or self.bytes <= 0 or self.directories <= 0 or time.time() >= self.deadline
+
+    def spend(self, children, size):
+        self.entries -= len(children)
+        self.bytes -= size
+        self.directories -= 1
+
+def listing_size(children):
+    return sum(len(name) + ENTRY_SIZE for name in children)
+
+def is_skipped(name):
+    return name.startswith('.') or name in SKIPPED_DIRECTORIES
+
+def read_directory(path, dir_stat, limit):
+    """Returns {name: stat} for the children of path, or None if there are more than limit of them.
+    The directory is read afresh if its stat is given; otherwise it may come from the listing cache."""
+    listing_cache = get_listing_cache()
+    if dir_stat is not None:
+        key, children = directory_key(dir_stat), None
+    else:
+        key, children = listing_cache.lookup(path)
+
+    if children is None:
+        entries = stat_children(path, limit)
+        if entries is None:
+            return None
+
+        children = {}
+        for name, child_path, child_stat in entries:
+            children[name] = process_stat(child_stat)
+        listing_cache.store(path, key, children)
+
+    if limit is not None and len(children) > limit:
+        return None
+    return children
+
+def explore_directory(base, base_stat, budget, unexplored):
+    """Yields (relPath, children) for base, then as many of its subdirectories as budget allows.
+    Shallow, small directories are listed first. The base directory is always listed in full.
+    relPaths of directories found but not listed are added to unexplored."""
+    queue = [(0, 0, '.')]
+    while len(queue) > 0:
+        depth, size_hint, rel_path = heapq.heappop(queue)
+        is_base = (rel_path == '.')
+        if not is_base and budget.exhausted():
+            unexplored.append(rel_path)
+            unexplored.extend(item[2] for item in queue)
+            return
+
+        try:
+            if is_base:
+                children = read_directory(base, base_stat, None)
+            else:
+                children = read_directory(os.path.join(base, rel_path), None, budget.entries)
+        except OSError as err:
+            if is_base:
+                raise err # Only raise read errors on the requested directory.
+            logging.warning('Error: ' + str(err))
+            continue
+
+        size = 0 if children is None else listing_size(children)
+        if not is_base and (children is None or size > budget.bytes):
+            # Too big for what's left of the budget; smaller directories may still fit.
+            unexplored.append(rel_path)
+            continue
+
+        budget.spend(children, size)
+        yield rel_path, children
+
+        for name, child_stat in children.items():
+            if child_stat[0] & FileType.DIRECTORY:
+                child_path = os.path.join(rel_path, name)
+                # relPaths start with './'; globs are matched without it.
+                if is_skipped(name) or budget.excludes.match(child_path[2:]):
+                    unexplored.append(child_path)
+                else:
+                    # Directory sizes roughly track their number of entries.
+                    heapq.heappush(queue, (depth + 1, child_stat[3], child_path))
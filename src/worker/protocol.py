@@ -1,9 +1,15 @@
+import errno
+import io
+import os
+import struct
 import sys
-import msgpack
 import logging
 import binascii
+import threading
+from codec import get_codec
+from compression import Compressor, choose_codec
 from definitions import ParcelType
-import sys
+from errors import Error
 
 is_python_3 = (sys.version_info >= (3, 0))
 if is_python_3:
@@ -11,50 +17,393 @@ if is_python_3:
     stdout = sys.stdout.buffer
 else:
     stdin = sys.stdin
-    stdout = sys.stdout
+    stdout = io.open(sys.stdout.fileno(), 'wb', closefd=False)
+
+try:
+    from os import sendfile
+except ImportError:
+    sendfile = None
+
+# Maximum number of tagged requests handled at once by a single worker.
+MAX_CONCURRENT_REQUESTS = 8
+
+# Size of BODY parcels used when streaming files.
+BODY_CHUNK_SIZE = 1024 * 1024
+
+# Tracks the channel and ID of the request being handled on each thread, so its parcels can be tagged and sent to the right place.
+request_context = threading.local()
+
+# Starting size of the message read buffer; grows to fit large messages, and shrinks back when idle.
+READ_BUFFER_SIZE = 64 * 1024
+
+# Message size prefixes are msgpack'd uints; map of type byte to struct format.
+SIZE_PREFIX_FORMATS = { 0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q' }
+
+def raw_reader(stream):
+    # Returns a function which reads whatever is available (up to the size of the target) into a writable buffer.
+    raw = getattr(stream, 'raw', None)
+    if raw is not None and hasattr(raw, 'readinto'):
+        return raw.readinto
+
+    fd = stream.fileno()
+    def read_into(target):
+        chunk = os.read(fd, len(target))
+        target[:len(chunk)] = chunk
+        return len(chunk)
+    return read_into
 
 class MessageReader:
-    def __init__(self):
-        self.message_size = 0
+    """Reads size-prefixed msgpack messages. Input is read in large pieces into one reusable buffer,
+    and the unpacker is fed one whole message at a time."""
+
+    def __init__(self, stream):
+        self.read_into = raw_reader(stream)
+        self.buffer = bytearray(READ_BUFFER_SIZE)
+        self.start = 0
+        self.end = 0
+        self.unpacker = get_codec().unpacker()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        frame_size = self.read_frame_size()
+        if frame_size is None or not self.fill(frame_size):
+            raise StopIteration()
+
+        frame = memoryview(self.buffer)[self.start:self.start + frame_size]
+        self.start += frame_size
+        try:
+            self.unpacker.feed(frame)
+        finally:
+            if hasattr(frame, 'release'):
+                frame.release()
+
+        return self.unpacker.unpack()
+
+    next = __next__ # Python 2
+
+    def has_buffered_message(self):
+        # True if a whole message has already been read from the input, so won't trigger select().
+        prefix = self.peek_frame_size()
+        return prefix is not None and self.end - self.start >= prefix[0] + prefix[1]
+
+    def peek_frame_size(self):
+        # Returns (prefix size, message size), or None if the size prefix isn't fully buffered yet.
+        if self.end <= self.start:
+            return None
+
+        pack_header = self.buffer[self.start]
+        if pack_header < 0x80:
+            return 1, pack_header
+
+        size_format = SIZE_PREFIX_FORMATS.get(pack_header)
+        if size_format is None:
+            raise ValueError('Invalid message size prefix: ' + hex(pack_header))
+
+        prefix_size = 1 + struct.calcsize(size_format)
+        if self.end - self.start < prefix_size:
+            return None
+        return prefix_size, struct.unpack_from(size_format, self.buffer, self.start + 1)[0]
+
+    def read_frame_size(self):
+        if not self.fill(1):
+            return None
+
+        prefix = self.peek_frame_size()
+        if prefix is None:
+            if not self.fill(1 + struct.calcsize(SIZE_PREFIX_FORMATS[self.buffer[self.start]])):
+                return None
+            prefix = self.peek_frame_size()
+
+        self.start += prefix[0]
+        return prefix[1]
+
+    def fill(self, size):
+        # Ensures at least size bytes are buffered; returns False at the end of input.
+        while self.end - self.start < size:
+            if self.start == self.end:
+                self.start = self.end = 0
+                if len(self.buffer) > READ_BUFFER_SIZE and size <= READ_BUFFER_SIZE:
+                    self.buffer = bytearray(READ_BUFFER_SIZE)
+
+            if len(self.buffer) - self.start < size:
+                # Move buffered data to the front, and grow the buffer if that's still not enough space.
+                buffered = self.end - self.start
+                self.buffer[:buffered] = self.buffer[self.start:self.end]
+                self.start = 0
+                self.end = buffered
+                if len(self.buffer) < size:
+                    self.buffer.extend(bytearray(size - len(self.buffer)))
+
+            target = memoryview(self.buffer)[self.end:]
+            try:
+                count = self.read_into(target)
+            finally:
+                if hasattr(target, 'release'):
+                    target.release()
+
+            if not count:
+                return False
+            self.end += count
+
+        return True
 
-    def read_message_size(self):
-        pack_header = stdin.read(1)
-        if len(pack_header) == 0:
-            return 0
+class Channel:
+    """A client's message stream: requests are read from input, and responses written to output.
+    A worker has one, on stdin / stdout; a daemon has one for each connected relay."""
 
-        read_size = { 0xcc: 1, 0xcd: 2, 0xce: 4, 0xcf: 8 }.get(ord(pack_header), 0)
-        if read_size > 0:
-            pack_header += stdin.read(read_size)
-        self.message_size = msgpack.unpackb(pack_header, raw=True)
+    def __init__(self, input, output):
+        self.input = input
+        self.output = output
+        # Parcels may be sent from several handler threads at once; each must reach the output in one piece.
+        self.write_lock = threading.Lock()
+        self.message_reader = None
+        self.startup_time = None
 
-    def read(self, bytes):
-        if self.message_size <= 0:
-            self.read_message_size()
+    def get_message_reader(self):
+        # Only one reader per channel; it may have read ahead of the message it last returned.
+        if self.message_reader is None:
+            self.message_reader = MessageReader(self.input)
+        return self.message_reader
 
-        read_bytes = stdin.read(min(16384, self.message_size))
-        self.message_size -= len(read_bytes)
-        return read_bytes
+standard_channel = Channel(stdin, stdout)
+
+def socket_channel(sock):
+    # Plain file objects on the socket's descriptor; writes accept memoryviews, and sendfile() works on them.
+    return Channel(io.open(sock.fileno(), 'rb', closefd=False), io.open(sock.fileno(), 'wb', closefd=False))
+
+def set_channel(channel):
+    request_context.channel = channel
+
+def get_channel():
+    return getattr(request_context, 'channel', standard_channel)
 
 def prepare_message_reader():
-    return msgpack.Unpacker(MessageReader(), raw=False)
+    return get_channel().get_message_reader()
+
+def set_request_id(request_id):
+    request_context.request_id = request_id
+
+def get_request_id():
+    return getattr(request_context, 'request_id', None)
 
 def send_error(code, message):
-    send_parcel(ParcelType.ERROR, msgpack.packb({ 'code': code, 'error': message }))
+    send_parcel(ParcelType.ERROR, get_codec().packb({ 'code': code, 'error': message }))
 
 def send_response_header(response):
-    send_parcel(ParcelType.HEADER, msgpack.packb(response))
+    send_parcel(ParcelType.HEADER, get_codec().packb(response))
+
+def send_streaming_header(response):
+    # For responses whose body is a run of BODY parcels of no announced length, ended by ENDOFBODY. Clients take a
+    # header without a length to be the whole response, unless it's marked as streaming.
+    response['streaming'] = True
+    send_response_header(response)
+
+def pack_size(size):
+    # Equivalent to msgpack.packb(size) for non-negative ints, without building a Packer.
+    if size < 0x80:
+        return struct.pack('>B', size)
+    elif size <= 0xff:
+        return struct.pack('>BB', 0xcc, size)
+    elif size <= 0xffff:
+        return struct.pack('>BH', 0xcd, size)
+    elif size <= 0xffffffff:
+        return struct.pack('>BI', 0xce, size)
+    else:
+        return struct.pack('>BQ', 0xcf, size)
+
+def pack_parcel_header(parcel_type, length):
+    request_id = get_request_id()
+    if request_id is None:
+        return struct.pack('>B', parcel_type) + pack_size(length)
+    else:
+        return struct.pack('>B', parcel_type | ParcelType.TAGGED) + get_codec().packb(request_id) + pack_size(length)
 
 def send_parcel(parcel_type, data):
-    stdout.write(bytearray([parcel_type]))
-    stdout.write(msgpack.packb(len(data)))
-    stdout.write(data)
-    stdout.flush()
+    header = pack_parcel_header(parcel_type, len(data))
+    channel = get_channel()
+    with channel.write_lock:
+        channel.output.write(header)
+        channel.output.write(data)
+        channel.output.flush()
+
+class FileBodySource:
+    """Copies ranges of an open file to a channel's output, avoiding a fresh bytes object per chunk.
+    Uses sendfile where possible, otherwise reads through one reusable buffer. Files aren't mmap'd;
+    one truncated by another process mid-transfer would crash the worker with SIGBUS."""
+
+    def __init__(self, fh, length, hasher, allow_sendfile=True):
+        self.fh = fh
+        self.fd = fh.fileno()
+        self.length = length
+        self.hasher = hasher
+        self.use_sendfile = allow_sendfile and sendfile is not None and hasher is None
+        self.buffer = None
+        self.written = 0 # Bytes of the current range written so far
+
+    def close(self):
+        self.buffer = None
+
+    def write_to(self, out, offset, size):
+        # Returns False if the file ended early; the remainder of the range is padded with zeros. If reading fails,
+        # the range is padded likewise before the error is raised, so the parcel it belongs to is still whole.
+        self.written = 0
+        try:
+            if self.use_sendfile:
+                sent = self.sendfile_to(out, offset, size)
+                if sent is not None:
+                    return self.pad(out, size - sent)
+
+                # sendfile is unsupported for these file descriptors; sendfile doesn't move the file position.
+                self.use_sendfile = False
+                self.fh.seek(offset)
+
+            chunk = self.read_chunk(size)
+            out.write(chunk)
+            self.written = len(chunk)
+            return self.pad(out, size - len(chunk))
+        except EnvironmentError:
+            self.pad(out, size - self.written)
+            raise
+
+    def compress_to(self, compressor, offset, size):
+        # Returns False if the file ended early; as with write_to, the remainder is padded with zeros.
+        chunk = self.read_chunk(size)
+        send_compressed_chunk(compressor, chunk)
+        if len(chunk) < size:
+            send_compressed_chunk(compressor, bytearray(size - len(chunk)))
+            return False
+        return True
+
+    def read_chunk(self, size):
+        # Reads the next size bytes into the buffer; returns a view of them, which is only valid until the next call.
+        # Short if the file shrank.
+        if self.buffer is None:
+            self.buffer = memoryview(bytearray(BODY_CHUNK_SIZE))
+        chunk = self.buffer[:size]
+        chunk = chunk[:self.read_into(chunk)]
+
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+        return chunk
+
+    def sendfile_to(self, out, offset, size):
+        out.flush()
+        out_fd = out.fileno()
+        sent = 0
+        while sent < size:
+            try:
+                count = sendfile(out_fd, self.fd, offset + sent, size - sent)
+            except OSError as err:
+                if sent == 0 and err.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    return None
+                raise
+            if count == 0:
+                break
+            sent += count
+            self.written = sent
+        return sent
+
+    def read_into(self, chunk):
+        read = 0
+        while read < len(chunk):
+            count = self.fh.readinto(chunk[read:])
+            if not count:
+                break
+            read += count
+        return read
+
+    def pad(self, out, missing):
+        if missing > 0:
+            out.write(bytearray(missing))
+            return False
+        return True
+
+def send_file_body(fh, length, hasher=None, compressor=None):
+    """Streams the first length bytes of fh as BODY parcels, followed by ENDOFBODY.
+    If a hasher is supplied, it is updated with every byte sent. If a compressor is supplied,
+    BODY parcels contain its compressed stream rather than raw file content.
+    If the file shrank while being sent, the body (padded with zeros to keep parcels whole) is followed by an ERROR
+    parcel instead of ENDOFBODY, so the client discards it; returns False in that case."""
+    if not send_file_content(fh, length, hasher, compressor):
+        send_error(Error.EIO, 'File shrank while being read')
+        return False
+    send_parcel(ParcelType.ENDOFBODY, b'')
+    return True
+
+def send_file_content(fh, length, hasher=None, compressor=None, exact=False):
+    # As send_file_body, without the closing ENDOFBODY or ERROR. Returns False if the file shrank, cutting the body
+    # short once the current parcel has been padded out with zeros; the caller must tell the client to discard it.
+    # If exact is set (uncompressed bodies only), the body is always length bytes: padded with zeros if the file
+    # shrank, or if reading it failed, in which case the error is raised once the body is complete.
+    source = FileBodySource(fh, length, hasher, allow_sendfile=(compressor is None))
+    channel = get_channel()
+    offset = 0
+    complete = True
+    try:
+        while offset < length:
+            size = min(BODY_CHUNK_SIZE, length - offset)
+            if compressor is None:
+                with channel.write_lock:
+                    channel.output.write(pack_parcel_header(ParcelType.BODY, size))
+                    try:
+                        complete = source.write_to(channel.output, offset, size)
+                    finally:
+                        offset += size # The parcel is filled, even if reading failed
+                    channel.output.flush()
+            else:
+                complete = source.compress_to(compressor, offset, size)
+                offset += size
+
+            if not complete:
+                logging.warning('File shrank while being sent; ' + ('padded with zeros' if exact else 'body abandoned'))
+                break
+    finally:
+        source.close()
+        if exact:
+            send_padding(length - offset)
+
+    if compressor is not None:
+        send_parcel(ParcelType.BODY, compressor.flush())
+    return complete
+
+def send_padding(size):
+    # Zeros, as BODY parcels.
+    while size > 0:
+        chunk_size = min(BODY_CHUNK_SIZE, size)
+        send_parcel(ParcelType.BODY, bytearray(chunk_size))
+        size -= chunk_size
+
+def send_compressed_chunk(compressor, chunk):
+    compressed = compressor.compress(chunk)
+    if len(compressed) > 0:
+        send_parcel(ParcelType.BODY, compressed)
+
+def send_compressible_response(packed, args):
+    """Sends a msgpack'd response that may be large (eg; LS results). If the client accepts compression and it's worth it,
+    the header only describes the encoding and the response follows compressed, as BODY parcels."""
+    codec = choose_codec(args, packed)
+    if codec is None:
+        send_parcel(ParcelType.HEADER, packed)
+        return
+
+    send_response_header({'compression': codec, 'length': len(packed)})
+    compressor = Compressor(codec)
+    view = memoryview(packed)
+    for offset in range(0, len(packed), BODY_CHUNK_SIZE):
+        send_compressed_chunk(compressor, view[offset:offset + BODY_CHUNK_SIZE])
+    send_parcel(ParcelType.BODY, compressor.flush())
+    send_parcel(ParcelType.ENDOFBODY, b'')
 
 def send_empty_parcel():
-    sys.stdout.write(msgpack.packb(0))
+    sys.stdout.write(get_codec().packb(0))
 
 def send_warning(message):
+    # Warnings are plain UTF-8 text, rather than msgpack.
+    if not isinstance(message, bytes):
+        message = message.encode('utf-8')
     send_parcel(ParcelType.WARNING, message)
 
 def send_change_notice(paths):
-    send_parcel(ParcelType.CHANGE_NOTICE, msgpack.packb(paths))
+    send_parcel(ParcelType.CHANGE_NOTICE, get_codec().packb(paths))
@@ -0,0 +1,292 @@
+import logging
+import mmap
+import os
+import re
+import threading
+from collections import deque
+
+from errors import Error, CodedError
+from tools import get_glob_set, list_files, walk_directories
+
+# Defaults for the limits clients may set in SEARCH args.
+MAX_FILE_SIZE = 20 * 1024 * 1024 # Larger files are skipped (bytes)
+MAX_RESULTS = 10000               # Searches stop once they've found this many matches
+
+# Number of files searched by each task handed to a search process.
+FILES_PER_TASK = 32
+
+# Tasks queued for search processes at once. Enough to keep them busy; few enough that little work
+# is wasted when a search stops early.
+MAX_PENDING_TASKS = 16
+
+MAX_PROCESSES = 8
+
+# Files with a NUL byte in this many leading bytes are taken to be binary, and skipped.
+BINARY_SAMPLE_SIZE = 8192
+
+# Longest preview of a match's line (bytes), and how much of that may come before the match.
+PREVIEW_LENGTH = 250
+PREVIEW_LEAD = 50
+
+def compile_pattern(args):
+    """Returns (source, flags, fold_case) for a bytes regex matching the pattern in SEARCH args; raises CodedError if
+    it's invalid. If fold_case is set, the regex is to be run over lowercased text. Only ASCII letters are folded."""
+    pattern = args['pattern']
+    if not isinstance(pattern, bytes):
+        pattern = pattern.encode('utf-8')
+    ignore_case = not args.get('isCaseSensitive')
+
+    # Literal patterns are matched against lowercased text when ignoring case, rather than with re.IGNORECASE;
+    # bytes.lower() is far faster than a case-insensitive match. Both fold only ASCII letters.
+    fold_case = ignore_case and not args.get('isRegExp')
+    if fold_case:
+        pattern = pattern.lower()
+    if not args.get('isRegExp'):
+        pattern = re.escape(pattern)
+    if args.get('isWordMatch'):
+        pattern = b'\\b(?:' + pattern + b')\\b'
+
+    flags = re.MULTILINE
+    if ignore_case and not fold_case:
+        flags |= re.IGNORECASE
+
+    try:
+        re.compile(pattern, flags)
+    except re.error as err:
+        raise CodedError(Error.EINVAL, 'Invalid search pattern: ' + str(err))
+    return pattern, flags, fold_case
+
+def decode(data):
+    return data.decode('utf-8', 'replace')
+
+def is_continuation_byte(data, offset):
+    return ord(data[offset:offset + 1]) & 0xC0 == 0x80
+
+def find_matches(data, regex, limit, haystack):
+    """Returns [line, column, length, preview, previewColumn] for up to limit matches of regex in haystack; either data,
+    or a lowercased copy. Lines and columns count from 0, and columns and lengths are in characters, as in VS Code.
+    Previews are an excerpt of the line the match starts on, with previewColumn the match's position in it."""
+    matches = []
+    line = 0
+    line_start = 0
+    counted = 0    # Newlines before this offset have been counted
+    column = 0
+    column_end = 0 # Offset on the current line up to which column has been counted
+
+    for match in regex.finditer(haystack):
+        start, end = match.span()
+        if start == end:
+            continue
+
+        # Lines and columns are counted incrementally from the previous match; long lines aren't rescanned per match.
+        newlines = data[counted:start].count(b'\n')
+        if newlines > 0:
+            line += newlines
+            line_start = data.rfind(b'\n', counted, start) + 1
+            column = 0
+            column_end = line_start
+        counted = start
+        column += len(decode(data[column_end:start]))
+        column_end = start
+
+        preview_start = max(line_start, start - PREVIEW_LEAD)
+        while preview_start < start and is_continuation_byte(data, preview_start):
+            preview_start += 1
+        preview_end = data.find(b'\n', start, preview_start + PREVIEW_LENGTH)
+        if preview_end < 0:
+            preview_end = min(len(data), preview_start + PREVIEW_LENGTH)
+            while preview_end > end and preview_end < len(data) and is_continuation_byte(data, preview_end):
+                preview_end -= 1
+
+        preview = decode(data[preview_start:preview_end]).rstrip('\r')
+        matches.append([line, column, len(decode(data[start:end])), preview, len(decode(data[preview_start:start]))])
+        if len(matches) >= limit:
+            break
+
+    return matches
+
+def search_file(path, regex, fold_case, max_file_size, limit, map_file):
+    """Returns (matches, bytes scanned) for a file; see find_matches. Empty, oversized and binary files aren't scanned.
+    Files are only mapped into memory by search processes; one truncated while mapped raises SIGBUS, which would
+    take the worker down with it."""
+    with open(path, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0 or size > max_file_size:
+            return [], 0
+
+        data = mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ) if map_file else fh.read(size)
+        try:
+            if b'\0' in data[:BINARY_SAMPLE_SIZE]:
+                return [], 0
+            return find_matches(data, regex, limit, data[:].lower() if fold_case else data), len(data)
+        finally:
+            if map_file:
+                try:
+                    data.close()
+                except BufferError:
+                    pass # Still referenced by a match; closed when that is collected.
+
+def search_files(task, map_files=True):
+    """Searches a batch of files, stopping once limit matches are found. Runs in search processes, or in-process
+    with map_files unset. Returns ([[relPath, matches]], files searched, bytes scanned)."""
+    source, flags, fold_case, base, rel_paths, max_file_size, limit = task
+    regex = re.compile(source, flags)
+    results = []
+    files = 0
+    scanned = 0
+    for rel_path in rel_paths:
+        if limit <= 0:
+            break
+
+        try:
+            matches, size = search_file(os.path.join(base, rel_path), regex, fold_case, max_file_size, limit, map_files)
+        except (EnvironmentError, ValueError):
+            continue # Unreadable, vanished, or can't be mapped
+
+        files += 1
+        scanned += size
+        if len(matches) > 0:
+            results.append([rel_path, matches])
+            limit -= len(matches)
+
+    return results, files, scanned
+
+def create_search_pool():
+    try:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Search processes are forked from a fork server; the worker has threads by now, and forking it could
+        # leave a child holding a lock no thread will release. The server runs from the worker's sys.path
+        # (which may be its zip), and imports this module up front so each fork starts ready to search.
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['search'])
+        return ProcessPoolExecutor(min(MAX_PROCESSES, multiprocessing.cpu_count()), mp_context=context)
+    except (ImportError, AttributeError, TypeError, ValueError, NotImplementedError, OSError) as err:
+        logging.warning('Searching in-process; unable to start search processes: ' + str(err))
+        return False
+
+search_pool_lock = threading.Lock()
+loaded_search_pool = None
+def get_search_pool():
+    """Returns a process pool executor to run search_files in, or False if processes can't be used (eg; on python 2)."""
+    global loaded_search_pool
+    with search_pool_lock:
+        if loaded_search_pool == None:
+            loaded_search_pool = create_search_pool()
+        return loaded_search_pool
+
+def discard_search_pool(pool):
+    global loaded_search_pool
+    with search_pool_lock:
+        if loaded_search_pool is pool:
+            loaded_search_pool = None
+    pool.shutdown(wait=False)
+
+class TextSearch:
+    """Searches the files beneath a directory for a pattern, per SEARCH args. Files are searched in batches
+    across a pool of processes, each mapping files into memory and scanning them with a bytes regex.
+    Include and exclude globs are matched against paths relative to the directory."""
+
+    def __init__(self, base, args):
+        self.base = os.path.join(base, '')
+        self.source, self.flags, self.fold_case = compile_pattern(args)
+        self.includes = get_glob_set(args.get('includes', []))
+        self.excludes = get_glob_set(args.get('excludes', []))
+        self.max_file_size = args.get('maxFileSize', MAX_FILE_SIZE)
+        self.max_results = args.get('maxResults', MAX_RESULTS)
+        self.results = 0
+        self.files = 0
+        self.bytes = 0
+        self.limit_hit = False
+
+    def is_included(self, rel_path):
+        if self.excludes.match(rel_path):
+            return False
+        return len(self.includes.globs) == 0 or self.includes.match(rel_path)
+
+    def find_files(self):
+        """Yields the paths of files to search, relative to base. Excluded directories aren't descended into."""
+        prefix_length = len(self.base)
+        for directory in walk_directories(self.base, lambda name, path: self.excludes.match(path[prefix_length:])):
+            try:
+                files = list(list_files(directory))
+            except OSError:
+                continue # Vanished since listing
+
+            for name, path in files:
+                if self.is_included(path[prefix_length:]):
+                    yield path[prefix_length:]
+
+    def batches(self):
+        batch = []
+        for rel_path in self.find_files():
+            batch.append(rel_path)
+            if len(batch) == FILES_PER_TASK:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def make_task(self, rel_paths):
+        return (self.source, self.flags, self.fold_case, self.base, rel_paths, self.max_file_size, self.max_results - self.results)
+
+    def collect(self, outcome):
+        # Tasks run concurrently may find more matches between them than are wanted; drop the excess.
+        results, files, scanned = outcome
+        self.files += files
+        self.bytes += scanned
+
+        kept = []
+        for rel_path, matches in results:
+            remaining = self.max_results - self.results
+            if remaining <= 0:
+                break
+            kept.append([rel_path, matches[:remaining]])
+            self.results += len(kept[-1][1])
+
+        self.limit_hit = self.results >= self.max_results
+        return kept
+
+    def wait(self, pool, future):
+        try:
+            return future.result()
+        except Exception as err:
+            # eg; a search process was killed. Start a fresh pool for the next search.
+            discard_search_pool(pool)
+            raise CodedError(Error.EIO, 'Search failed: ' + str(err))
+
+    def run(self):
+        """Yields lists of [relPath, matches] as they're found, until every file has been searched or max_results
+        matches have been found; see find_matches for the format of matches."""
+        pool = get_search_pool()
+        if not pool:
+            for rel_paths in self.batches():
+                results = self.collect(search_files(self.make_task(rel_paths), map_files=False))
+                if len(results) > 0:
+                    yield results
+                if self.limit_hit:
+                    return
+            return
+
+        # Files are still being found while earlier batches are searched. Any tasks left queued
+        # when the search stops (having hit its limit, or failed to send results) are cancelled.
+        batches = self.batches()
+        pending = deque()
+        try:
+            while not self.limit_hit:
+                while len(pending) < MAX_PENDING_TASKS:
+                    rel_paths = next(batches, None)
+                    if rel_paths is None:
+                        break
+                    pending.append(pool.submit(search_files, self.make_task(rel_paths)))
+
+                if len(pending) == 0:
+                    break
+
+                results = self.collect(self.wait(pool, pending.popleft()))
+                if len(results) > 0:
+                    yield results
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,66 @@
+import threading
+import time
+
+# Average time per call (seconds) above which calls are spread across threads. Local filesystems answer
+# far quicker than this; network filesystems (NFS, SSHFS) are often much slower.
+PARALLEL_LATENCY = 0.0002
+
+# Number of calls made one at a time at the start of each batch, to measure their latency.
+PROBE_COUNT = 4
+
+MAX_THREADS = 16
+
+def call(function, item):
+    try:
+        return function(item)
+    except OSError as err:
+        return err
+
+class StatEngine:
+    """Runs batches of blocking filesystem metadata calls (stat, listdir, etc). The first few calls of a batch
+    are made in turn to measure their latency; if slow, the rest are spread over a thread pool, using more
+    threads the slower they are. Such calls release the GIL while they wait, so they overlap well."""
+
+    def __init__(self, max_threads):
+        self.max_threads = max_threads
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                from multiprocessing.pool import ThreadPool
+                self.pool = ThreadPool(self.max_threads)
+            return self.pool
+
+    def choose_threads(self, latency, count):
+        if latency < PARALLEL_LATENCY:
+            return 1
+        return min(self.max_threads, count, int(latency / PARALLEL_LATENCY))
+
+    def map(self, function, items):
+        """Returns function(item) for each item, in order. OSErrors are returned in place of results, rather than raised."""
+        items = list(items)
+        probe_count = min(PROBE_COUNT, len(items))
+
+        start = time.time()
+        results = [call(function, item) for item in items[:probe_count]]
+        remaining = items[probe_count:]
+        if len(remaining) == 0:
+            return results
+
+        threads = self.choose_threads((time.time() - start) / probe_count, len(remaining))
+        if threads <= 1:
+            results.extend(call(function, item) for item in remaining)
+        else:
+            # One task per thread; limits this batch to that many threads, even if the pool is larger.
+            chunk_size = (len(remaining) + threads - 1) // threads
+            results.extend(self.get_pool().map(lambda item: call(function, item), remaining, chunk_size))
+        return results
+
+loaded_stat_engine = None
+def get_stat_engine():
+    global loaded_stat_engine
+    if loaded_stat_engine == None:
+        loaded_stat_engine = StatEngine(MAX_THREADS)
+    return loaded_stat_engine
@@ -1,10 +1,18 @@
+import logging
+import os
 import re
 import stat
 from definitions import FileType
+from statengine import get_stat_engine
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
 
 def process_stat(osStat):
-    mode = osStat[stat.ST_MODE]
-    
+    mode = osStat.st_mode
+
     fileType = 0
     if stat.S_ISREG(mode):
         fileType = FileType.FILE
@@ -15,13 +23,118 @@ def process_stat(osStat):
 
     return [
         fileType,
-        osStat[stat.ST_MTIME],
-        osStat[stat.ST_CTIME],
-        osStat[stat.ST_SIZE]
+        int(osStat.st_mtime),
+        int(osStat.st_ctime),
+        osStat.st_size
     ]
 
+def stat_entry(entry):
+    # DirEntry.stat() follows symlinks, like os.stat, and is cached on the entry.
+    return entry.stat()
+
+def list_children(path):
+    # Returns ([(name, path)], [item], stat) for the children of a directory, where stat(item) stats a child;
+    # items are DirEntries, which need no paths built to stat, or paths where scandir is unavailable.
+    if scandir is None:
+        names = os.listdir(path)
+        paths = [os.path.join(path, name) for name in names]
+        return list(zip(names, paths)), paths, os.stat
+
+    entries = scandir(path)
+    try:
+        items = list(entries)
+    finally:
+        if hasattr(entries, 'close'):
+            entries.close()
+    return [(entry.name, entry.path) for entry in items], items, stat_entry
+
+def stat_children(path, limit=None):
+    """Returns [(name, path, stat)] for each child of a directory, following symlinks; or None if it has more than limit children.
+    Listed with scandir where available. Stats are made in parallel when they turn out to be slow.
+    Children which can't be stat'd (eg; broken links) are logged and skipped."""
+    named, items, stat_item = list_children(path)
+    if limit is not None and len(items) > limit:
+        return None
+
+    children = []
+    for (name, child_path), child_stat in zip(named, get_stat_engine().map(stat_item, items)):
+        if isinstance(child_stat, OSError):
+            logging.warning('Skipping ' + child_path + ': ' + str(child_stat))
+        else:
+            children.append((name, child_path, child_stat))
+    return children
+
+# Number of directories listed together while walking a tree.
+WALK_BATCH_SIZE = 64
+
+def list_subdirectories(path):
+    """Yields (name, path) for each directory inside path, not following symlinks."""
+    if scandir is None:
+        for name in os.listdir(path):
+            child_path = os.path.join(path, name)
+            if not os.path.islink(child_path) and os.path.isdir(child_path):
+                yield name, child_path
+        return
+
+    entries = scandir(path)
+    try:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.name, entry.path
+            except OSError:
+                pass # Vanished since listing
+    finally:
+        if hasattr(entries, 'close'):
+            entries.close()
+
+def walk_directories(root, skip_directory):
+    """Iteratively yields root and every readable directory beneath it, without following symlinks.
+    Directories for which skip_directory(name, path) is true are neither yielded nor descended into."""
+    yield root
+
+    # Directories are yielded once they have been successfully listed; saves checking access separately.
+    # Pending directories are listed in batches, in parallel if listing turns out to be slow.
+    pending = [(root, False)]
+    while len(pending) > 0:
+        batch = pending[-WALK_BATCH_SIZE:]
+        del pending[-WALK_BATCH_SIZE:]
+
+        listings = get_stat_engine().map(lambda path: list(list_subdirectories(path)), [path for path, unyielded in batch])
+        for (path, unyielded), subdirectories in zip(batch, listings):
+            if isinstance(subdirectories, OSError):
+                continue # Unreadable, vanished, or not a directory.
+
+            if unyielded:
+                yield path
+
+            for name, child_path in subdirectories:
+                if not skip_directory(name, child_path):
+                    pending.append((child_path, True))
+
+def list_files(path):
+    """Yields (name, path) for each regular file inside path, following symlinks."""
+    if scandir is None:
+        for name in os.listdir(path):
+            child_path = os.path.join(path, name)
+            if os.path.isfile(child_path):
+                yield name, child_path
+        return
+
+    entries = scandir(path)
+    try:
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    yield entry.name, entry.path
+            except OSError:
+                pass # Vanished since listing
+    finally:
+        if hasattr(entries, 'close'):
+            entries.close()
+
 def vscode_glob_piece_to_regexp(glob_piece):
-    atomic_tokens = re.finditer(r'\/(\*\*)|(\*\*)\/|(\*)|(\?)|(\[(?:\\?.)*?\])', glob_piece)
+    atomic_tokens = re.finditer(r'\/(\*\*)|(\*\*)\/|(\*\*)|(\*)|(\?)|(\[(?:\\?.)*?\])', glob_piece)
     cursor = 0
     regex = ''
     for token in atomic_tokens:
@@ -29,13 +142,18 @@ def vscode_glob_piece_to_regexp(glob_piece):
             regex += re.escape(glob_piece[cursor:token.start()])
         cursor = token.end()
 
+        # ** matches any number of whole path segments (including none); * and ? never match a separator.
         token_type = token.group()
         if token_type == '*':
-            regex += '[^/]+'
-        elif token_type == '/**' or token_type == '**/':
+            regex += '[^/]*'
+        elif token_type == '/**':
+            regex += '(?:/.*)?'
+        elif token_type == '**/':
+            regex += '(?:.*/)?'
+        elif token_type == '**':
             regex += '.*'
         elif token_type == '?':
-            regex += '.'
+            regex += '[^/]'
         else:
             regex += token_type
     
@@ -61,4 +179,60 @@ def vscode_glob_to_regexp(glob):
     if cursor < len(glob):
         regex += vscode_glob_piece_to_regexp(glob[cursor:])
 
-    return re.compile(regex + '$')
\ No newline at end of file
+    return re.compile(regex + '$')
+
+# Globs which match on a path's name alone: **/name, **/*suffix, and **/name/** (which matches paths with name as any component).
+BASENAME_GLOB = re.compile(r'^\*\*/([^/*?\[\]{}]+)$')
+SUFFIX_GLOB = re.compile(r'^\*\*/\*([^/*?\[\]{}]+)$')
+COMPONENT_GLOB = re.compile(r'^\*\*/([^/*?\[\]{}]+)/\*\*$')
+
+class GlobSet:
+    """Matches paths against a set of VS Code globs in one go. The most common forms of glob are matched on the
+    path's name or components, without regexes; the rest are folded into a single regex alternation."""
+
+    def __init__(self, globs):
+        self.globs = tuple(globs)
+        self.names = set()
+        self.suffixes = ()
+        self.components = set()
+
+        patterns = []
+        for glob in self.globs:
+            basename = BASENAME_GLOB.match(glob)
+            suffix = SUFFIX_GLOB.match(glob)
+            component = COMPONENT_GLOB.match(glob)
+            if basename:
+                self.names.add(basename.group(1))
+            elif suffix:
+                self.suffixes += (suffix.group(1),)
+            elif component:
+                self.components.add(component.group(1))
+            else:
+                patterns.append(vscode_glob_to_regexp(glob).pattern)
+
+        self.regex = re.compile('|'.join('(?:' + pattern + ')' for pattern in patterns)) if len(patterns) > 0 else None
+
+    def match(self, path):
+        """Returns True if any of the globs match the whole of path."""
+        if self.names or self.suffixes:
+            name = path[path.rfind('/') + 1:]
+            if name in self.names or (self.suffixes and name.endswith(self.suffixes)):
+                return True
+        if self.components and not self.components.isdisjoint(path.split('/')):
+            return True
+        return self.regex is not None and self.regex.match(path) is not None
+
+# Number of distinct sets of globs to keep compiled.
+MAX_GLOB_SETS = 64
+
+loaded_glob_sets = {}
+def get_glob_set(globs):
+    """Returns a GlobSet for globs, reusing one compiled earlier for the same globs if possible."""
+    key = tuple(globs)
+    glob_set = loaded_glob_sets.get(key)
+    if glob_set is None:
+        if len(loaded_glob_sets) >= MAX_GLOB_SETS:
+            loaded_glob_sets.clear()
+        glob_set = GlobSet(key)
+        loaded_glob_sets[key] = glob_set
+    return glob_set
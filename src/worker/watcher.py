@@ -1,60 +1,163 @@
 import ctypes
 import errno
+import fcntl
 import logging
 import os
 import select
 import struct
-import sys
+import termios
 import time
 
 from definitions import Opcode, ChangeType
 from errors import CodedError
 from libc import get_libc
-from protocol import prepare_message_reader, send_change_notice, send_warning
-from tools import vscode_glob_to_regexp
+from protocol import get_channel, prepare_message_reader, send_change_notice, send_warning
+from tools import get_glob_set, walk_directories
+
+# Default time to wait for more changes after one arrives, before notifying the client. Reduces noise.
+COALESCE_WINDOW = 0.05
+
+# Default longest time to hold on to changes while waiting for a stream of them to end.
+MAX_LATENCY = 0.5
+
+class InotifyBuffer:
+    """Reusable buffer of raw inotify events. Reads are sized using FIONREAD, and events are
+    parsed in place; only the names of changed files are copied out."""
+
+    def __init__(self, fd, header_format, initial_size=65536):
+        self.fd = fd
+        self.header = struct.Struct(header_format)
+        self.buffer = bytearray(initial_size)
+        self.used = 0
+
+    def available(self):
+        raw_count = fcntl.ioctl(self.fd, termios.FIONREAD, b'\0\0\0\0')
+        return max(struct.unpack('i', raw_count)[0], self.header.size)
+
+    def read(self):
+        wanted = self.used + self.available()
+        if wanted > len(self.buffer):
+            self.buffer.extend(bytearray(max(wanted, len(self.buffer) * 2) - len(self.buffer)))
+
+        target = memoryview(self.buffer)[self.used:wanted]
+        if hasattr(os, 'readv'):
+            self.used += os.readv(self.fd, [target])
+        else:
+            chunk = os.read(self.fd, len(target))
+            target[:len(chunk)] = chunk
+            self.used += len(chunk)
+
+    def events(self):
+        """Returns a list of (watch descriptor, mask, name) for each complete event in the buffer, and removes them."""
+        events = []
+        buffer = self.buffer
+        header_size = self.header.size
+        offset = 0
+        while self.used - offset >= header_size:
+            wd, watch_mask, _, name_length = self.header.unpack_from(buffer, offset)
+            name_start = offset + header_size
+            end = name_start + name_length
+            if end > self.used:
+                break
+
+            # Names are padded with NULs to an alignment boundary.
+            name_end = buffer.find(b'\0', name_start, end)
+            if name_end < 0:
+                name_end = end
+            events.append((wd, watch_mask, buffer[name_start:name_end].decode('latin-1')))
+            offset = end
+
+        # Keep any partial event at the start of the buffer; normally there are none.
+        if offset < self.used:
+            buffer[:self.used - offset] = buffer[offset:self.used]
+        self.used -= offset
+        return events
 
 class Watcher:
-    def __init__(self):
+    def __init__(self, coalesce_window=COALESCE_WINDOW, max_latency=MAX_LATENCY):
         self.libc = get_libc()
         self.inotify_fd = self.libc.inotify_init()
         if self.inotify_fd < 0:
             raise CodedError(self.inotify_fd, 'Failed to initiailize inotify')
 
-        self.inotify_buffer = None
+        self.inotify_buffer = InotifyBuffer(self.inotify_fd, self.libc.INOTIFY_HEADER_FORMAT)
         self.watch_ids = {}
         self.watch_descriptors = {}
+        self.watch_excludes = {}
+        self.recursive_watches = set()
+        self.out_of_watches = False
+
+        # Watches removed here, whose IN_IGNORED event hasn't arrived yet; events may still be queued for them.
+        self.removed_descriptors = set()
+
+        # Counts of events received, and of those dropped for matching their watch's excludes; per watch id.
+        self.event_counts = {}
+        self.suppressed_counts = {}
+
+        self.channel = get_channel()
         self.message_reader = prepare_message_reader()
         self.home_dir = os.path.expanduser('~')
 
+        self.coalesce_window = coalesce_window
+        self.max_latency = max_latency
+        self.pending_changes = {}
+        self.first_change_time = None
+        self.last_change_time = None
+
     def run(self):
         done = False
         while not done:
-            ready = select.select([self.inotify_fd, sys.stdin], [], [])
+            ready = select.select([self.inotify_fd, self.channel.input], [], [], self.time_until_flush())
             for stream in ready[0]:
-                if stream == sys.stdin:
-                    self.read_stdin()
+                if stream == self.channel.input:
+                    done = not self.read_stdin()
                 else:
                     self.read_notify()
 
+            if self.time_until_flush() == 0:
+                self.flush_changes()
+
+    def close(self):
+        # Also removes every watch.
+        for watch_id in self.watch_ids:
+            self.log_event_counts(watch_id)
+        os.close(self.inotify_fd)
+
+    def log_event_counts(self, watch_id):
+        logging.info('Watch %d received %d events, suppressing %d matching excludes' % (
+            watch_id, self.event_counts.get(watch_id, 0), self.suppressed_counts.get(watch_id, 0)))
+
+    def time_until_flush(self):
+        # Changes are sent once no more have arrived for coalesce_window, or they have waited max_latency.
+        if self.first_change_time is None:
+            return None
+
+        flush_time = min(self.last_change_time + self.coalesce_window, self.first_change_time + self.max_latency)
+        return max(0, flush_time - time.time())
+
     def read_stdin(self):
-        [opcode, args] = next(self.message_reader)
-        if opcode == Opcode.ADD_WATCH:
-            self.add_watch(args['id'], args['path'], args['recursive'], args['excludes'])
-        elif opcode == Opcode.REMOVE_WATCH:
-            self.rm_watch(args['id'])
-        else:
-            logging.warn('Invalid opcode received by watcher: ' + str(opcode))
+        # Handle every message already read from stdin; any beyond the first won't trigger select() again.
+        # Returns False once stdin is closed.
+        for [opcode, args] in self.message_reader:
+            if opcode == Opcode.ADD_WATCH:
+                self.add_watch(args['id'], args['path'], args['recursive'], args['excludes'])
+            elif opcode == Opcode.REMOVE_WATCH:
+                self.rm_watch(args['id'])
+            else:
+                logging.warn('Invalid opcode received by watcher: ' + str(opcode))
+
+            if not self.message_reader.has_buffered_message():
+                return True
+        return False
 
     def find_paths(self, path, recursive, excludes):
-        yield(path)
-        if recursive and os.path.isdir(path):
-            for name in os.listdir(path):
-                child = os.path.join(path, name)
-                is_dir = not os.path.islink(child) and os.path.isdir(child)
-                if is_dir and name != '.pony-ssh' and not any(regex.match(child) for regex in excludes):
-                    if os.access(child, os.R_OK):
-                        for child_path in self.find_paths(child, True, excludes):
-                            yield child_path
+        if not recursive:
+            return [path]
+
+        def skip_directory(name, child):
+            return name == '.pony-ssh' or excludes.match(child)
+
+        return walk_directories(path, skip_directory)
 
     def add_watch(self, watch_id, path, recursive, excludes):
         collapse_home = (path[0] == '~')
@@ -64,34 +167,77 @@ class Watcher:
         if not os.path.exists(path):
             return
 
-        self.watch_ids[watch_id] = []
-        regex_excludes = map(vscode_glob_to_regexp, excludes)
-        for watch_path in self.find_paths(path, recursive, regex_excludes):
+        self.watch_ids[watch_id] = set()
+        self.watch_excludes[watch_id] = get_glob_set(excludes)
+        if recursive:
+            self.recursive_watches.add(watch_id)
+        self.event_counts[watch_id] = 0
+        self.suppressed_counts[watch_id] = 0
+
+        start_time = time.time()
+        walked, watched = self.watch_tree(watch_id, path, recursive, collapse_home)
+        logging.info('Walked %d directories under %s, watching %d; took %.3fs' % (walked, path, watched, time.time() - start_time))
+
+    def watch_tree(self, watch_id, path, recursive, collapse_home):
+        """Adds inotify watches for watch_id on path and, if recursive, the directories beneath it which aren't excluded.
+        Returns the number of directories (walked, watched)."""
+        walked = 0
+        watched = 0
+        for watch_path in self.find_paths(path, recursive, self.watch_excludes[watch_id]):
+            walked += 1
             watch_wd = self.libc.inotify_add_watch(self.inotify_fd, watch_path.encode('latin-1'), self.libc.IN_ALL_CHANGES)
             if watch_wd < 0:
                 error = ctypes.get_errno()
                 error_string = os.strerror(error)
 
                 if error == errno.ENOSPC or error == errno.ENOMEM:
-                    # Kernel has no more space for watches. Give up.
-                    send_warning('Too many directories to watch. The remote system has reached its limit for inotify watches. ' +
-                        'Please increase the watcher limit on your remote system, or consider adding patterns to your "Watcher ' + 
-                        'Exclude" setting in Visual Studio Code to reduce the number of folders watched.')
-                    return
+                    # Kernel has no more space for watches. Give up; warning only once until some are freed.
+                    if not self.out_of_watches:
+                        send_warning('Too many directories to watch. The remote system has reached its limit for inotify watches. ' +
+                            'Please increase the watcher limit on your remote system, or consider adding patterns to your "Watcher ' +
+                            'Exclude" setting in Visual Studio Code to reduce the number of folders watched.')
+                    self.out_of_watches = True
+                    break
 
                 send_warning('Failed to watch ' + watch_path + ': ' + error_string)
             else:
-                self.watch_ids[watch_id].append(watch_wd)
-                self.watch_descriptors[watch_wd] = (watch_id, path, collapse_home)
+                watched += 1
+                self.watch_ids[watch_id].add(watch_wd)
+                self.watch_descriptors[watch_wd] = (watch_id, watch_path, collapse_home)
+
+        return walked, watched
+
+    def forget_descriptor(self, watch_wd):
+        # Once a watch is gone, whether removed here or by the kernel.
+        entry = self.watch_descriptors.pop(watch_wd, None)
+        if entry is not None and entry[0] in self.watch_ids:
+            self.watch_ids[entry[0]].discard(watch_wd)
+        self.out_of_watches = False
+
+    def remove_descriptor(self, watch_wd):
+        self.libc.inotify_rm_watch(self.inotify_fd, watch_wd)
+        self.removed_descriptors.add(watch_wd)
+        self.forget_descriptor(watch_wd)
+
+    def unwatch_tree(self, watch_id, path):
+        # Removes watch_id's watches on path and the directories beneath it. Scans every watch; only used
+        # when directories are moved, which is rare compared to files changing.
+        prefix = os.path.join(path, '')
+        for watch_wd, (owner, watch_path, collapse_home) in list(self.watch_descriptors.items()):
+            if owner == watch_id and (watch_path == path or watch_path.startswith(prefix)):
+                self.remove_descriptor(watch_wd)
 
     def rm_watch(self, watch_id):
         if watch_id in self.watch_ids:
-            for watch_wd in self.watch_ids[watch_id]:
-                self.libc.inotify_rm_watch(watch_wd)
-                if watch_wd in self.watch_descriptors:
-                    del self.watch_descriptors[watch_wd]
+            for watch_wd in list(self.watch_ids[watch_id]):
+                self.remove_descriptor(watch_wd)
             del self.watch_ids[watch_id]
 
+            self.log_event_counts(watch_id)
+            self.recursive_watches.discard(watch_id)
+            for per_watch in (self.watch_excludes, self.event_counts, self.suppressed_counts):
+                del per_watch[watch_id]
+
     def process_change_type(self, watch_mask):
         if watch_mask & self.libc.IN_CREATED_CHANGES:
             return ChangeType.CREATED
@@ -101,21 +247,17 @@ class Watcher:
             return ChangeType.CHANGED
 
     def read_notify(self):
-        time.sleep(0.05) # Allow multiple close inotify messages to "bank up". Reduces noise.
-        chunk = os.read(self.inotify_fd, 2048)
-        self.inotify_buffer = chunk if self.inotify_buffer is None else self.inotify_buffer + chunk
-        changes = {}
-        while len(self.inotify_buffer) > self.libc.INOTIFY_HEADER_SIZE:
-            raw_header = self.inotify_buffer[:self.libc.INOTIFY_HEADER_SIZE]
-            header = struct.unpack(self.libc.INOTIFY_HEADER_FORMAT, raw_header)
-            wd, watch_mask, _, name_length = header
-
-            total_size = self.libc.INOTIFY_HEADER_SIZE + name_length
-            if len(self.inotify_buffer) < total_size:
-                break
+        self.inotify_buffer.read()
+        changes = self.pending_changes
+        for wd, watch_mask, name in self.inotify_buffer.events():
+            # Sent once a watch has gone; after rm_watch, or after IN_DELETE_SELF when a watched directory is deleted.
+            if watch_mask & self.libc.IN_IGNORED:
+                self.forget_descriptor(wd)
+                self.removed_descriptors.discard(wd)
+                continue
 
-            name = self.inotify_buffer[self.libc.INOTIFY_HEADER_SIZE:total_size].rstrip(b'\0').decode('latin-1')
-            self.inotify_buffer = self.inotify_buffer[total_size:]
+            if wd in self.removed_descriptors:
+                continue
 
             if wd not in self.watch_descriptors:
                 send_warning('Change to ' + name + ' found with an invalid watch descriptor: ' + str(wd))
@@ -123,6 +265,22 @@ class Watcher:
 
             watch_id, watch_path, collapse_home = self.watch_descriptors[wd]
             full_path = os.path.join(watch_path, name)
+
+            # Excludes are applied to events too, not just to choosing directories to watch; changes to excluded
+            # files in watched directories (eg; build output, editor swap files) are dropped here.
+            self.event_counts[watch_id] += 1
+            if self.watch_excludes[watch_id].match(full_path):
+                self.suppressed_counts[watch_id] += 1
+                continue
+
+            # Keep recursive watches in step with directories created and moved beneath them (those deleted are dropped
+            # on IN_IGNORED). New directories are walked and watched, at a cost proportional to their size, not the watch's.
+            if watch_mask & self.libc.IN_ISDIR and watch_id in self.recursive_watches:
+                if watch_mask & self.libc.IN_MOVED_FROM:
+                    self.unwatch_tree(watch_id, full_path)
+                elif watch_mask & self.libc.IN_CREATED_CHANGES and name != '.pony-ssh':
+                    self.watch_tree(watch_id, full_path, True, collapse_home)
+
             if collapse_home:
                 if full_path.startswith(self.home_dir):
                     full_path = '~' + full_path[len(self.home_dir):]
@@ -135,11 +293,21 @@ class Watcher:
             else:
                 changes[watch_id][full_path] |= watch_mask
 
+        if len(changes) > 0:
+            self.last_change_time = time.time()
+            if self.first_change_time is None:
+                self.first_change_time = self.last_change_time
+
+    def flush_changes(self):
         # Convert inotify watch flags to created/changed/deleted flags
         changes = {
             watch_id: {
                 path:self.process_change_type(watch_mask) for (path,watch_mask) in paths.items()
-            } for (watch_id,paths) in changes.items()
+            } for (watch_id,paths) in self.pending_changes.items()
         }
 
+        self.pending_changes = {}
+        self.first_change_time = None
+        self.last_change_time = None
+
         send_change_notice(changes)